@@ -0,0 +1,95 @@
+# api/authentication.py
+import copy
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+TOKEN_CACHE_SIZE = 1024
+
+
+class TokenCache:
+    """Кэш процесса token -> user с ограничением размера и TTL (LRU)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, key, user):
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic() + settings.TOKEN_LOCAL_CACHE_TIMEOUT, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+token_cache = TokenCache()
+
+
+def get_shared_key(key):
+    return f'auth_token:{key}'
+
+
+def invalidate_token(key):
+    """Сбрасывает кэш токена в этом процессе и в общем кэше.
+
+    В других процессах запись живёт не дольше TOKEN_LOCAL_CACHE_TIMEOUT.
+    """
+    token_cache.delete(key)
+    cache.delete(get_shared_key(key))
+
+
+def invalidate_user_tokens(user):
+    for key in Token.objects.filter(user=user).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запроса к базе на каждый вызов API.
+
+    Пользователь по токену ищется в кэше процесса, затем в общем кэше
+    Django (если он включён) и только потом в базе.
+    """
+
+    def authenticate_credentials(self, key):
+        user = token_cache.get(key)
+        if user is None:
+            # TOKEN_CACHE_TIMEOUT = 0 - общий слой выключен (нет общего
+            # бэкенда кэша, см. settings)
+            shared = settings.TOKEN_CACHE_TIMEOUT > 0
+            user = cache.get(get_shared_key(key)) if shared else None
+            if user is None:
+                user, _token = super().authenticate_credentials(key)
+                if shared:
+                    cache.set(get_shared_key(key), user,
+                              settings.TOKEN_CACHE_TIMEOUT)
+            token_cache.set(key, user)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        # Копия, чтобы запросы не делили один объект пользователя
+        user = copy.copy(user)
+        return user, Token(key=key, user=user)
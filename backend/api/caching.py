@@ -0,0 +1,67 @@
+# api/caching.py
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from recipes.versions import get_data_version
+from rest_framework import status
+from rest_framework.response import Response
+
+LOCAL_CACHE_SIZE = 1024
+
+
+class VersionedLocalCache:
+    """Кэш процесса, сбрасываемый при смене версии данных"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, namespace, version, key):
+        cached_version, entries = self._entries.get(namespace, (None, {}))
+        if cached_version != version:
+            return None
+        return entries.get(key)
+
+    def set(self, namespace, version, key, value):
+        with self._lock:
+            cached_version, entries = self._entries.get(namespace, (None, {}))
+            if cached_version != version or len(entries) >= LOCAL_CACHE_SIZE:
+                entries = {}
+            entries[key] = value
+            self._entries[namespace] = (version, entries)
+
+
+local_cache = VersionedLocalCache()
+
+
+def versioned_response(request, namespace, key, build):
+    """Ответ со справочными данными из кэша с поддержкой ETag.
+
+    Данные кэшируются в памяти процесса и в общем кэше Django под ключом
+    с версией namespace, поэтому любая запись в модель их инвалидирует.
+    """
+    version = get_data_version(namespace)
+    key_hash = hashlib.sha1(str(key).encode()).hexdigest()
+    etag = quote_etag(f'{namespace}-{version}-{key_hash}')
+    headers = {
+        'ETag': etag,
+        'Cache-Control': (
+            f'public, max-age={settings.REFERENCE_CACHE_MAX_AGE}, '
+            'must-revalidate'),
+    }
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    data = local_cache.get(namespace, version, key_hash)
+    if data is None:
+        shared_key = f'reference:{namespace}:{version}:{key_hash}'
+        data = cache.get(shared_key)
+        if data is None:
+            data = build()
+            cache.set(shared_key, data, settings.REFERENCE_CACHE_TIMEOUT)
+        local_cache.set(namespace, version, key_hash, data)
+    return Response(data, headers=headers)
@@ -0,0 +1,18 @@
+# api/filters.py
+from recipes.search import search_recipes
+from rest_framework.filters import BaseFilterBackend
+
+
+class RecipeSearchFilter(BaseFilterBackend):
+    """Полнотекстовый поиск рецептов по параметру search"""
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        queryset = search_recipes(queryset, query)
+        if 'ordering' in request.query_params:
+            return queryset
+        # По умолчанию сначала самые релевантные
+        return queryset.order_by('-search_rank', *queryset.query.order_by)
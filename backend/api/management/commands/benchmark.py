@@ -0,0 +1,232 @@
+# api/management/commands/benchmark.py
+import gc
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from recipes.models import Ingredient, Recipe, Tag
+from recipes.versions import INGREDIENTS, bump_data_version
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from users.models import CustomUser
+
+from ...utils import (
+    get_shopping_list_pdf_key, get_shopping_list_version,
+    process_shopping_list,
+)
+
+DEFAULT_BASELINE = os.path.join(settings.BASE_DIR, 'benchmark_baseline.json')
+
+# Метрики, по которым сравнивается с базовой линией
+METRICS = ('p50_ms', 'p95_ms', 'queries', 'peak_kb')
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = round(percent / 100 * (len(values) - 1))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = ('Замер времени ответа (p50/p95), числа SQL-запросов и пиковой '
+            'памяти основных эндпоинтов API на текущей базе '
+            '(см. seed_load) и сравнение с базовой линией. Сценарии '
+            '*_uncached сбрасывают кэш перед каждым запросом и меняют '
+            'версию справочников')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--user', help='username пользователя для '
+                                           'авторизованных запросов')
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+        parser.add_argument('--save', action='store_true',
+                            help='Записать результаты как базовую линию')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Сколько раз повторить замер, в итог '
+                                 'идут медианы метрик')
+        parser.add_argument('--tolerance', type=float, default=0.3,
+                            help='Допустимый рост времени и памяти (доля)')
+        parser.add_argument('--slack-ms', type=float, default=5.0,
+                            help='Рост времени меньше этого не считается '
+                                 'регрессией')
+        parser.add_argument('--only', action='append', dest='scenarios',
+                            help='Запустить только указанный сценарий')
+
+    def handle(self, *args, **options):
+        # Тестовый клиент ходит на хост testserver
+        with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            self.run(options)
+
+    def run(self, options):
+        user = self.get_user(options['user'])
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        scenarios = self.get_scenarios(user)
+        if options['scenarios']:
+            scenarios = {
+                name: scenario for name, scenario in scenarios.items()
+                if name in options['scenarios']
+            }
+        results = {}
+        for name, (path, reset) in scenarios.items():
+            runs = [
+                self.measure(path, options['iterations'], options['warmup'],
+                             reset)
+                for _ in range(max(options['repeat'], 1))
+            ]
+            # Медиана повторов сглаживает шум; число запросов - худшее
+            results[name] = {
+                metric: (max if metric == 'queries' else statistics.median)(
+                    run[metric] for run in runs)
+                for metric in METRICS
+            }
+            self.stdout.write(
+                f'{name:<26} p50={results[name]["p50_ms"]:>8.1f}ms '
+                f'p95={results[name]["p95_ms"]:>8.1f}ms '
+                f'queries={results[name]["queries"]:>3} '
+                f'peak={results[name]["peak_kb"]:>8.1f}KB')
+
+        if options['save']:
+            with open(options['baseline'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+            self.stdout.write(f'Базовая линия записана в '
+                              f'{options["baseline"]}')
+            return
+        if not os.path.exists(options['baseline']):
+            self.stdout.write('Базовой линии нет, запустите с --save')
+            return
+        with open(options['baseline'], encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = self.compare(results, baseline, options['tolerance'],
+                                   options['slack_ms'])
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError(f'Регрессий: {len(regressions)}')
+        self.stdout.write('Регрессий нет')
+
+    def get_user(self, username):
+        users = CustomUser.objects.all()
+        if username:
+            users = users.filter(username=username)
+        else:
+            # По умолчанию - пользователь с самым длинным списком покупок
+            users = users.annotate(
+                items=Count('shopping_list')).order_by('-items', 'pk')
+        user = users.first()
+        if user is None:
+            raise CommandError('Пользователь не найден, сначала seed_load')
+        return user
+
+    def get_scenarios(self, user):
+        tag = Tag.objects.order_by('pk').first()
+        recipe = Recipe.objects.order_by('-favorites_count', 'pk').first()
+        ingredient = Ingredient.objects.order_by('pk').first()
+        if recipe is None or tag is None or ingredient is None:
+            raise CommandError('В базе нет данных, сначала seed_load')
+        ingredient_search = f'/api/ingredients/?name={ingredient.name[:2]}'
+        shopping_cart_pdf = '/api/recipes/download_shopping_cart/'
+
+        def reset_ingredients():
+            # Новая версия сбрасывает индекс поиска и кэш ответов
+            bump_data_version(INGREDIENTS)
+
+        def reset_shopping_cart_pdf():
+            version = get_shopping_list_version(process_shopping_list(user))
+            cache.delete(get_shopping_list_pdf_key(user, version))
+
+        # Сценарий: (путь, сброс кэша перед каждым запросом или None)
+        return {
+            'recipes': ('/api/recipes/?limit=10', None),
+            'recipes_tags': (f'/api/recipes/?limit=10&tags={tag.slug}',
+                             None),
+            'recipes_favorited': ('/api/recipes/?limit=10&is_favorited=1',
+                                  None),
+            'recipes_in_cart': (
+                '/api/recipes/?limit=10&is_in_shopping_cart=1', None),
+            'recipe_detail': (f'/api/recipes/{recipe.pk}/', None),
+            'users': ('/api/users/?limit=10', None),
+            'subscriptions': ('/api/users/subscriptions/'
+                              '?limit=10&recipes_limit=3', None),
+            'ingredient_search': (ingredient_search, None),
+            'ingredient_search_uncached': (ingredient_search,
+                                           reset_ingredients),
+            'shopping_cart_pdf': (shopping_cart_pdf, None),
+            'shopping_cart_pdf_uncached': (shopping_cart_pdf,
+                                           reset_shopping_cart_pdf),
+            'shopping_cart_txt': ('/api/recipes/download_shopping_cart/'
+                                  '?file_ext=txt', None),
+        }
+
+    def request(self, path):
+        response = self.client.get(path)
+        if response.status_code >= 400:
+            raise CommandError(f'{path}: HTTP {response.status_code}')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def measure(self, path, iterations, warmup, reset=None):
+        reset = reset or (lambda: None)
+        for _ in range(warmup):
+            reset()
+            self.request(path)
+        durations, queries = [], 0
+        # Сборщик мусора отключается на время замеров, чтобы его паузы
+        # не попадали в p95 случайных запросов
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(iterations):
+                reset()
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    self.request(path)
+                    durations.append((time.perf_counter() - start) * 1000)
+                queries = max(queries, len(context))
+        finally:
+            gc.enable()
+        # Память - отдельным проходом: tracemalloc замедляет запросы
+        reset()
+        tracemalloc.start()
+        self.request(path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            'p50_ms': round(statistics.median(durations), 2),
+            'p95_ms': round(percentile(durations, 95), 2),
+            'queries': queries,
+            'peak_kb': round(peak / 1024, 1),
+        }
+
+    def compare(self, results, baseline, tolerance, slack_ms):
+        """Описания метрик, ухудшившихся сверх допуска"""
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            for metric in METRICS:
+                old, new = baseline[name][metric], result[metric]
+                if metric == 'queries':
+                    # Число запросов не должно расти вовсе
+                    limit = old
+                elif metric.endswith('_ms'):
+                    limit = max(old * (1 + tolerance), old + slack_ms)
+                else:
+                    limit = old * (1 + tolerance)
+                if new > limit:
+                    regressions.append(
+                        f'{name}.{metric}: {old} -> {new}')
+        return regressions
@@ -0,0 +1,115 @@
+# api/management/commands/check_query_budget.py
+import re
+
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.db.transaction import atomic, set_rollback
+from django.test.utils import CaptureQueriesContext, override_settings
+from recipes.models import Recipe, ShoppingCart, ShoppingListIngredient
+from recipes.relations import add_relations
+from rest_framework.test import APIClient
+from users.models import CustomUser
+
+PAGE_SIZES = (1, 10, 50)
+
+ENDPOINTS = {
+    'recipes': '/api/recipes/?limit={size}',
+    'recipes_cursor': '/api/recipes/?limit={size}&pagination=cursor',
+    'recipes_facets': '/api/recipes/?limit={size}&facets=1',
+    'recipes_feed': '/api/recipes/feed/?limit={size}',
+    'users': '/api/users/?limit={size}',
+    'subscriptions': '/api/users/subscriptions/?limit={size}',
+    'subscriptions_recipes': ('/api/users/subscriptions/'
+                              '?limit={size}&recipes_limit=3'),
+}
+
+# Для выгрузки списка покупок "размер страницы" - число рецептов в корзине
+CART_ENDPOINTS = {
+    'download_shopping_cart_pdf': '/api/recipes/download_shopping_cart/',
+    'download_shopping_cart_txt': ('/api/recipes/download_shopping_cart/'
+                                   '?file_ext=txt'),
+}
+
+
+def normalize(sql):
+    """Шаблон запроса: числа и строки заменены на ?, списки IN свёрнуты"""
+    sql = re.sub(r"'[^']*'|\b\d+\b", '?', sql)
+    return re.sub(r'IN \((\?, )*\?\)', 'IN (...)', sql)
+
+
+class Command(BaseCommand):
+    help = ('Проверка, что число SQL-запросов списковых эндпоинтов не '
+            'зависит от размера страницы (1, 10, 50). Запускается на базе '
+            'с данными (см. seed_load), изменения откатываются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='username пользователя')
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['user'])
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        failures = []
+        with override_settings(ALLOWED_HOSTS=['testserver']), atomic():
+            for name, path in ENDPOINTS.items():
+                if not self.check_endpoint(name, path, lambda size: None):
+                    failures.append(name)
+            recipe_ids = list(Recipe.objects.order_by('pk').values_list(
+                'pk', flat=True)[:max(PAGE_SIZES)])
+            for name, path in CART_ENDPOINTS.items():
+                if not self.check_endpoint(
+                        name, path,
+                        lambda size: self.fill_cart(user, recipe_ids[:size])):
+                    failures.append(name)
+            set_rollback(True)
+        if failures:
+            raise CommandError(f'Число запросов растёт: {", ".join(failures)}')
+        self.stdout.write('Число запросов не зависит от размера страницы')
+
+    def get_user(self, username):
+        users = CustomUser.objects.all()
+        if username:
+            users = users.filter(username=username)
+        else:
+            # Пользователь с наибольшим числом подписок
+            users = users.annotate(
+                following_count=Count('subscribers')
+            ).order_by('-following_count', 'pk')
+        user = users.first()
+        if user is None:
+            raise CommandError('Пользователь не найден, сначала seed_load')
+        return user
+
+    def fill_cart(self, user, recipe_ids):
+        ShoppingCart.objects.filter(user=user).delete()
+        ShoppingListIngredient.objects.filter(user=user).delete()
+        add_relations(ShoppingCart, {'user': user}, 'recipe', recipe_ids)
+        ShoppingListIngredient.objects.add_recipes(user, recipe_ids)
+
+    def request(self, path):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        if response.status_code >= 400:
+            raise CommandError(f'{path}: HTTP {response.status_code}')
+        return [query['sql'] for query in context.captured_queries]
+
+    def check_endpoint(self, name, path, prepare):
+        runs = {}
+        for size in PAGE_SIZES:
+            prepare(size)
+            runs[size] = self.request(path.format(size=size))
+        counts = {size: len(queries) for size, queries in runs.items()}
+        self.stdout.write(f'{name:<28} ' + ' '.join(
+            f'{size}:{count}' for size, count in counts.items()))
+        if len(set(counts.values())) == 1:
+            return True
+        smallest = Counter(map(normalize, runs[min(PAGE_SIZES)]))
+        largest = Counter(map(normalize, runs[max(PAGE_SIZES)]))
+        for sql, count in (largest - smallest).items():
+            self.stderr.write(f'  +{count} x {sql}')
+        return False
@@ -0,0 +1,136 @@
+# api/middleware.py
+import json
+import logging
+import time
+
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """Обёртка execute_wrapper: число запросов, суммарное и худшее время"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = (0.0, None)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            if duration > self.slowest[0]:
+                self.slowest = (duration, sql)
+
+
+class ProfiledStream:
+    """Содержимое потокового ответа, по окончании которого вызывается finish.
+
+    close() вызывается Django после отдачи ответа, в том числе если поток
+    не дочитан.
+    """
+
+    def __init__(self, content, finish):
+        self._content = iter(content)
+        self._finish = finish
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._content)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if self._finish is not None:
+            finish, self._finish = self._finish, None
+            finish()
+
+
+class RequestProfilingMiddleware:
+    """Профилирование запросов без DEBUG.
+
+    Считает SQL-запросы, время в БД, самый медленный запрос и время
+    рендеринга ответа, отдаёт их в заголовке Server-Timing и пишет
+    строку JSON в лог. Запросы сверх QUERY_BUDGET логируются как warning.
+    Включается переменной окружения REQUEST_PROFILING=True.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        request._render_duration = 0.0
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+            if response.streaming:
+                # Запросы идут и при чтении потока: обёртки снимаются,
+                # а отчёт пишется, когда поток исчерпан или закрыт
+                response['Server-Timing'] = 'db;desc="streaming"'
+                stack = stack.pop_all()
+
+                def finish():
+                    stack.close()
+                    self.report(request, response, stats,
+                                time.perf_counter() - start, headers=False)
+
+                response.streaming_content = ProfiledStream(
+                    response.streaming_content, finish)
+                return response
+        total = time.perf_counter() - start
+        self.report(request, response, stats, total)
+        return response
+
+    def process_template_response(self, request, response):
+        # Рендеринг ответа DRF - это сериализация данных в JSON
+        start = time.perf_counter()
+
+        def rendered(response):
+            request._render_duration = time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def report(self, request, response, stats, total, headers=True):
+        slowest_duration, slowest_sql = stats.slowest
+        if headers:
+            response['Server-Timing'] = ', '.join((
+                f'db;dur={stats.duration * 1000:.1f};'
+                f'desc="{stats.count} queries"',
+                f'db-slowest;dur={slowest_duration * 1000:.1f}',
+                f'render;dur={request._render_duration * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ))
+        over_budget = stats.count > settings.QUERY_BUDGET
+        match = getattr(request, 'resolver_match', None)
+        logger.log(
+            logging.WARNING if over_budget else logging.INFO,
+            json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': match.view_name if match else None,
+                'status': response.status_code,
+                'queries': stats.count,
+                'db_ms': round(stats.duration * 1000, 1),
+                'slowest_ms': round(slowest_duration * 1000, 1),
+                'slowest_sql': slowest_sql,
+                'render_ms': round(request._render_duration * 1000, 1),
+                'total_ms': round(total * 1000, 1),
+                'over_budget': over_budget,
+            }, ensure_ascii=False),
+        )
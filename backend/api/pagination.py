@@ -0,0 +1,36 @@
+# api/pagination.py
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class LimitPageNumberPagination(PageNumberPagination):
+    """Постраничная пагинация с размером страницы из параметра limit"""
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class RecipeCursorPagination(CursorPagination):
+    """Курсорная пагинация ленты рецептов по (pub_date, id)"""
+    ordering = ('-pub_date', '-id')
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class FeedCursorPagination(CursorPagination):
+    """Курсорная пагинация ленты подписок по (feed_date, id)"""
+    ordering = ('-feed_date', '-id')
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class SubscriptionCursorPagination(CursorPagination):
+    """Курсорная пагинация подписок"""
+    ordering = ('-id',)
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+def get_paginator(request, cursor_class):
+    """Курсорная пагинация включается параметром ?pagination=cursor"""
+    if request.query_params.get('pagination') == 'cursor':
+        return cursor_class()
+    return LimitPageNumberPagination()
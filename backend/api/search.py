@@ -0,0 +1,62 @@
+# api/search.py
+import bisect
+import threading
+
+from itertools import islice
+
+from recipes.models import Ingredient
+from recipes.versions import INGREDIENTS, get_data_version
+
+
+class IngredientSearchIndex:
+    """Индекс ингредиентов в памяти процесса для автодополнения.
+
+    Пересобирается, когда меняется версия данных INGREDIENTS.
+    Совпадения по началу названия идут раньше совпадений по подстроке.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._index = ([], [])
+
+    def _ensure_current(self):
+        version = get_data_version(INGREDIENTS)
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            items = sorted(
+                (name.casefold(), ingredient_id, name, measurement_unit)
+                for ingredient_id, name, measurement_unit
+                in Ingredient.objects.values_list(
+                    'id', 'name', 'measurement_unit')
+            )
+            self._index = (
+                [item[0] for item in items],
+                [{'id': ingredient_id, 'name': name,
+                  'measurement_unit': measurement_unit}
+                 for _, ingredient_id, name, measurement_unit in items],
+            )
+            self._version = version
+
+    def search(self, query, limit):
+        self._ensure_current()
+        keys, items = self._index
+        query = query.casefold()
+        start = bisect.bisect_left(keys, query)
+        end = start
+        while end < len(keys) and end - start < limit and (
+                keys[end].startswith(query)):
+            end += 1
+        results = items[start:end]
+        if len(results) < limit:
+            results += islice((
+                items[index] for index, key in enumerate(keys)
+                if query in key and not key.startswith(query)
+            ), limit - len(results))
+        return results
+
+
+ingredient_index = IngredientSearchIndex()
@@ -2,14 +2,25 @@
 import base64
 import uuid
 
+from collections import Counter
+
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.db.transaction import atomic
 from recipes.models import (
-    Favorite, Ingredient, Recipe, RecipeIngredient, ShoppingCart, Tag,
+    Favorite, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    ShoppingListExport, ShoppingListIngredient, Tag, TimelineEntry,
 )
+from recipes.relations import add_relation
+from recipes.search import update_recipe_search_on_commit
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from users.models import CustomUser, Subscription
 
+from .utils import get_recipes_limit, get_subscribed_author_ids
+
 
 class Base64ImageField(serializers.ImageField):
     """Serializer поля image"""
@@ -49,11 +60,7 @@ class CustomUserSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
     def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-        if user.is_authenticated:
-            return Subscription.objects.filter(user=user, author=obj).exists()
-        else:
-            return False
+        return obj.id in get_subscribed_author_ids(self.context['request'])
 
 
 class SubscriptionSerializer(serializers.ModelSerializer):
@@ -72,17 +79,25 @@ class SubscriptionSerializer(serializers.ModelSerializer):
                   'last_name', 'is_subscribed', 'recipes', 'recipes_count')
 
     def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-        return Subscription.objects.filter(user=user,
-                                           author=obj.author).exists()
+        # Сериализуются только подписки текущего пользователя
+        return True
 
     def get_recipes(self, obj):
-        recipes = Recipe.objects.filter(author=obj.author)
+        # Рецепты подгружены в SubscriptionViewSet.list_subscriptions
+        recipes = getattr(obj.author, 'latest_recipes', None)
+        if recipes is None:
+            recipes = obj.author.recipes.all()[
+                :get_recipes_limit(self.context['request'])]
         return RecipeMinifiedSerializer(recipes, many=True,
                                         context=self.context).data
 
     def get_recipes_count(self, obj):
-        return Recipe.objects.filter(author=obj.author).count()
+        return obj.author.recipes_count
+
+
+def relation_error(message):
+    return serializers.ValidationError(
+        {api_settings.NON_FIELD_ERRORS_KEY: [message]})
 
 
 class SubscriptionCreateSerializer(serializers.Serializer):
@@ -96,22 +111,20 @@ class SubscriptionCreateSerializer(serializers.Serializer):
         fields = ('user', 'author')
 
     def validate(self, attrs):
-        user = self.context['request'].user
-        author = attrs['author']
-        if self.context['request'].method == 'POST':
-            if user == author:
-                raise serializers.ValidationError(
-                    'Невозможно подписаться на самого себя'
-                )
-        elif self.context['request'].method == 'DELETE':
-            try:
-                Subscription.objects.get(user=user, author=author)
-            except Subscription.DoesNotExist:
-                raise serializers.ValidationError('Подписка не найдена')
+        if self.context['request'].user == attrs['author']:
+            raise serializers.ValidationError(
+                'Невозможно подписаться на самого себя'
+            )
         return attrs
 
+    @atomic
     def create(self, validated_data):
-        return Subscription.objects.create(**validated_data)
+        if not add_relation(Subscription, **validated_data):
+            raise relation_error('Вы уже подписаны на этого автора')
+        subscription = Subscription(**validated_data)
+        TimelineEntry.objects.backfill(subscription.user,
+                                       [subscription.author_id])
+        return subscription
 
 
 class FavoriteCreteSerializer(serializers.Serializer):
@@ -122,21 +135,10 @@ class FavoriteCreteSerializer(serializers.Serializer):
         model = Favorite
         fields = ('user', 'recipe')
 
-    def validate(self, attrs):
-        user = self.context['request'].user
-        recipe = attrs['recipe']
-        if self.context['request'].method == 'POST':
-            if Favorite.objects.filter(user=user, recipe=recipe).exists():
-                raise serializers.ValidationError('Рецепт уже в избранном')
-        elif self.context['request'].method == 'DELETE':
-            if not Favorite.objects.filter(user=user, recipe=recipe).exists():
-                raise serializers.ValidationError(
-                    'Рецепт не найден в избранных'
-                )
-        return attrs
-
     def create(self, validated_data):
-        return Favorite.objects.create(**validated_data)
+        if not add_relation(Favorite, **validated_data):
+            raise relation_error('Рецепт уже в избранном')
+        return Favorite(**validated_data)
 
 
 class ShoppingCartCreateSerializer(serializers.Serializer):
@@ -147,23 +149,26 @@ class ShoppingCartCreateSerializer(serializers.Serializer):
         model = ShoppingCart
         fields = ('user', 'recipe')
 
-    def validate(self, attrs):
-        user = self.context['request'].user
-        recipe = attrs['recipe']
-
-        if self.context['request'].method == 'POST':
-            if ShoppingCart.objects.filter(user=user, recipe=recipe).exists():
-                raise serializers.ValidationError(
-                    'Рецепт уже в корзине')
-        elif self.context['request'].method == 'DELETE':
-            if not ShoppingCart.objects.filter(user=user,
-                                               recipe=recipe).exists():
-                raise serializers.ValidationError(
-                    'Рецепт не найден в корзине')
-        return attrs
-
+    @atomic
     def create(self, validated_data):
-        return ShoppingCart.objects.create(**validated_data)
+        if not add_relation(ShoppingCart, **validated_data):
+            raise relation_error('Рецепт уже в корзине')
+        shopping_cart = ShoppingCart(**validated_data)
+        ShoppingListIngredient.objects.add_recipe(shopping_cart.user,
+                                                  shopping_cart.recipe)
+        return shopping_cart
+
+
+class BulkRelationSerializer(serializers.Serializer):
+    """Пакет id рецептов или авторов для добавления/удаления связей"""
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_RELATIONS_LIMIT,
+    )
+
+    def validate_ids(self, value):
+        return list(dict.fromkeys(value))
 
 
 class CustomUserSignUpSerializer(serializers.ModelSerializer):
@@ -223,12 +228,17 @@ class RecipeSerializer(serializers.ModelSerializer):
         exclude = ('pub_date',)
 
     def get_is_favorited(self, obj):
+        # Для страниц списка флаг проставлен set_user_flags
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context['request'].user
         if user.is_authenticated:
             return Favorite.objects.filter(user=user, recipe=obj).exists()
         return False
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context['request'].user
         if user.is_authenticated:
             return ShoppingCart.objects.filter(user=user, recipe=obj).exists()
@@ -237,10 +247,9 @@ class RecipeSerializer(serializers.ModelSerializer):
 
 class RecipeIngredientCreateSerializer(serializers.ModelSerializer):
     """Serializer создания объектов в модели RecipeIngredient"""
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient'
-    )
+    # Ингредиенты загружаются одним запросом в
+    # RecipeCreateSerializer.validate_ingredients
+    id = serializers.IntegerField(source='ingredient_id')
 
     class Meta:
         model = RecipeIngredient
@@ -262,9 +271,8 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
     """Serializer создания объектов в модели Recipe"""
     ingredients = RecipeIngredientCreateSerializer(many=True)
     image = Base64ImageField()
-    tags = serializers.PrimaryKeyRelatedField(many=True,
-                                              queryset=Tag.objects.all(),
-                                              required=True)
+    tags = serializers.ListField(child=serializers.IntegerField(),
+                                 required=True)
 
     class Meta:
         model = Recipe
@@ -281,8 +289,29 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
         if not ingredients:
             raise serializers.ValidationError(
                 'Поле ингредиентов не может быть пустым')
+        ids = [ingredient['ingredient_id'] for ingredient in ingredients]
+        duplicates = sorted(pk for pk, count in Counter(ids).items()
+                            if count > 1)
+        if duplicates:
+            raise serializers.ValidationError(
+                f'Ингредиенты повторяются: {duplicates}')
+        found = Ingredient.objects.in_bulk(ids)
+        unknown = [pk for pk in ids if pk not in found]
+        if unknown:
+            raise serializers.ValidationError(
+                f'Ингредиенты не найдены: {unknown}')
+        for ingredient in ingredients:
+            ingredient['ingredient'] = found[ingredient.pop('ingredient_id')]
         return ingredients
 
+    def validate_tags(self, tags):
+        ids = list(dict.fromkeys(tags))
+        found = Tag.objects.in_bulk(ids)
+        unknown = [pk for pk in ids if pk not in found]
+        if unknown:
+            raise serializers.ValidationError(f'Теги не найдены: {unknown}')
+        return [found[pk] for pk in ids]
+
     def validate_cooking_time(self, value):
         if int(value) < 1:
             raise serializers.ValidationError(
@@ -312,33 +341,91 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
 
     @atomic(durable=True)
     def update(self, instance, validated_data):
-        instance.name = validated_data.get('name', instance.name)
-        instance.text = validated_data.get('text', instance.text)
-        instance.cooking_time = validated_data.get('cooking_time',
-                                                   instance.cooking_time)
-        instance.image.delete()
-        instance.image = validated_data.get('image', instance.image)
+        changed_fields = [
+            field for field in ('name', 'text', 'cooking_time')
+            if field in validated_data
+            and validated_data[field] != getattr(instance, field)
+        ]
+        for field in changed_fields:
+            setattr(instance, field, validated_data[field])
 
-        # Обновление тегов
-        new_tags = validated_data.pop('tags', [])
-        instance.tags.set(new_tags)
+        # Файл картинки заменяется, только если загружена новая
+        if validated_data.get('image'):
+            old_image = instance.image
+            instance.image = validated_data['image']
+            changed_fields.append('image')
+            if old_image:
+                transaction.on_commit(
+                    lambda: old_image.storage.delete(old_image.name))
 
-        # Обновление ингредиентов
-        new_ingredients_data = validated_data.pop('ingredients', [])
-        existing_recipe_ingredients = instance.recipe_ingredients.all()
-        existing_recipe_ingredients.delete()
+        if changed_fields:
+            instance.save(update_fields=changed_fields)
 
-        recipe_ingredients = [
-            RecipeIngredient(
-                recipe=instance,
-                ingredient=ingredient_data['ingredient'],
-                amount=ingredient_data['amount']
-            ) for ingredient_data in new_ingredients_data
-        ]
-        RecipeIngredient.objects.bulk_create(recipe_ingredients)
+        # Обновление тегов
+        if 'tags' in validated_data:
+            new_tags = validated_data['tags']
+            old_tag_ids = set(instance.tags.values_list('id', flat=True))
+            if {tag.pk for tag in new_tags} != old_tag_ids:
+                instance.tags.set(new_tags)
 
-        instance.save()
+        # Обновление ингредиентов
+        if 'ingredients' in validated_data:
+            self.update_ingredients(instance, validated_data['ingredients'])
         return instance
 
+    def update_ingredients(self, instance, ingredients):
+        """Применяет к рецепту только изменившиеся ингредиенты"""
+        existing = {
+            recipe_ingredient.ingredient_id: recipe_ingredient
+            for recipe_ingredient in instance.recipe_ingredients.all()
+        }
+        old_amounts = {
+            ingredient_id: recipe_ingredient.amount
+            for ingredient_id, recipe_ingredient in existing.items()
+        }
+        new_amounts = {
+            ingredient_data['ingredient'].pk: ingredient_data['amount']
+            for ingredient_data in ingredients
+        }
+        if new_amounts == old_amounts:
+            return
+
+        removed = old_amounts.keys() - new_amounts.keys()
+        if removed:
+            RecipeIngredient.objects.filter(
+                pk__in=[existing[ingredient_id].pk
+                        for ingredient_id in removed]).delete()
+        added = RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=instance, ingredient_id=ingredient_id,
+                             amount=amount)
+            for ingredient_id, amount in new_amounts.items()
+            if ingredient_id not in existing
+        )
+        if added:
+            # bulk_create не шлёт post_save, индекс обновляется явно
+            update_recipe_search_on_commit([instance.pk])
+        changed = []
+        for ingredient_id, amount in new_amounts.items():
+            if ingredient_id in existing and (
+                    existing[ingredient_id].amount != amount):
+                existing[ingredient_id].amount = amount
+                changed.append(existing[ingredient_id])
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
+
+        ShoppingListIngredient.objects.change_recipe(
+            instance, old_amounts, new_amounts)
+
     def to_representation(self, instance):
+        prefetch_related_objects(
+            [instance], 'recipe_ingredients__ingredient', 'tags')
         return RecipeSerializer(instance, context=self.context).data
+
+
+class ShoppingListExportSerializer(serializers.ModelSerializer):
+    """Serializer фоновой выгрузки списка покупок"""
+
+    class Meta:
+        model = ShoppingListExport
+        fields = ('id', 'status', 'created', 'error')
+        read_only_fields = fields
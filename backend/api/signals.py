@@ -0,0 +1,20 @@
+# api/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from users.models import CustomUser
+
+from .authentication import invalidate_token, invalidate_user_tokens
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    # Выход (djoser token/logout) и удаление пользователя
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(sender, instance, created, **kwargs):
+    # Смена пароля, деактивация и любое другое изменение пользователя
+    if not created:
+        invalidate_user_tokens(instance)
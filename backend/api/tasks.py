@@ -0,0 +1,86 @@
+# api/tasks.py
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from recipes.models import ShoppingListExport, TimelineEntry
+from users.models import CustomUser
+
+from .utils import (
+    get_cached_shopping_list_pdf, get_shopping_list_version,
+    process_shopping_list,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """Локальный пул потоков для фоновых задач, без внешнего брокера"""
+    return ThreadPoolExecutor(
+        max_workers=settings.SHOPPING_LIST_EXPORT_WORKERS,
+        thread_name_prefix='api-task',
+    )
+
+
+def submit_shopping_list_export(export):
+    """Ставит выгрузку в очередь после фиксации транзакции"""
+    transaction.on_commit(
+        lambda: get_executor().submit(render_shopping_list_export, export.pk)
+    )
+
+
+def render_shopping_list_export(export_id):
+    close_old_connections()
+    try:
+        export = ShoppingListExport.objects.select_related('user').get(
+            pk=export_id)
+        export.status = ShoppingListExport.RUNNING
+        export.save(update_fields=('status',))
+        try:
+            shopping_list = process_shopping_list(export.user)
+            version = get_shopping_list_version(shopping_list)
+            pdf = get_cached_shopping_list_pdf(shopping_list, export.user,
+                                               version)
+            export.version = version
+            export.file.save(f'{export.pk}.pdf', ContentFile(pdf),
+                             save=False)
+            export.status = ShoppingListExport.DONE
+        except Exception as error:
+            logger.exception('Ошибка выгрузки списка покупок %s', export_id)
+            export.status = ShoppingListExport.FAILED
+            export.error = str(error)
+        export.save()
+    except Exception:
+        # Исключения в пуле потоков иначе теряются в Future
+        logger.exception('Не удалось обработать выгрузку %s', export_id)
+    finally:
+        close_old_connections()
+
+
+def submit_timeline_refill(author_ids):
+    """Ставит в очередь раскладку рецептов авторов, у которых после
+    отписки подписчиков стало ровно TIMELINE_FANOUT_LIMIT"""
+    crossed = list(CustomUser.objects.filter(
+        pk__in=author_ids,
+        followers_count=settings.TIMELINE_FANOUT_LIMIT,
+    ).values_list('pk', flat=True))
+    if crossed:
+        transaction.on_commit(
+            lambda: get_executor().submit(refill_timelines, crossed))
+
+
+def refill_timelines(author_ids):
+    close_old_connections()
+    try:
+        with transaction.atomic():
+            TimelineEntry.objects.refill(author_ids)
+    except Exception:
+        logger.exception('Не удалось разложить рецепты авторов %s',
+                         author_ids)
+    finally:
+        close_old_connections()
@@ -28,6 +28,18 @@ urlpatterns = [
          SubscriptionViewSet.as_view({'post': 'subscribe',
                                       'delete': 'unsubscribe'}),
          name='subscribe-unsubscribe'),
+    path('users/subscribe/bulk/',
+         SubscriptionViewSet.as_view({'post': 'subscribe_bulk',
+                                      'delete': 'unsubscribe_bulk'}),
+         name='subscribe-unsubscribe-bulk'),
+    path('recipes/favorite/bulk/',
+         RecipeViewSet.as_view({'post': 'add_favorite_bulk',
+                                'delete': 'remove_favorite_bulk'}),
+         name='add_favorite-remove_favorite-bulk'),
+    path('recipes/shopping_cart/bulk/',
+         RecipeViewSet.as_view({'post': 'add_shopping_cart_bulk',
+                                'delete': 'remove_shopping_cart_bulk'}),
+         name='add_shopping_cart-remove_shopping_cart-bulk'),
     path('recipes/<int:pk>/favorite/',
          RecipeViewSet.as_view({'post': 'add_favorite',
                                 'delete': 'remove_favorite'}),
@@ -38,5 +50,10 @@ urlpatterns = [
          name='add_shopping_cart-remove_shopping_cart'),
     path('recipes/download_shopping_cart/', ShoppingCartViewSet.as_view(
         {'get': 'download_shopping_cart'}), name='download_shopping_cart'),
+    path('recipes/download_shopping_cart/jobs/', ShoppingCartViewSet.as_view(
+        {'post': 'create_export'}), name='shopping_cart_export_create'),
+    path('recipes/download_shopping_cart/jobs/<uuid:pk>/',
+         ShoppingCartViewSet.as_view({'get': 'retrieve_export'}),
+         name='shopping_cart_export'),
     path('', include(router.urls)),
 ]
@@ -1,7 +1,16 @@
 # api/utils.py
+import csv
+import hashlib
+import json
+import os
+
 from collections import namedtuple
+from functools import lru_cache
 from io import BytesIO
 
+from django.conf import settings
+from django.core.cache import cache
+from recipes.models import ShoppingListIngredient
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
@@ -9,6 +18,7 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
 from rest_framework import permissions
+from users.models import Subscription
 
 
 class IsAuthenticatedOrReadOnly(permissions.BasePermission):
@@ -18,6 +28,79 @@ class IsAuthenticatedOrReadOnly(permissions.BasePermission):
         return request.user and request.user.is_authenticated
 
 
+def get_subscribed_author_ids(request):
+    """Множество id авторов, на которых подписан пользователь.
+
+    Загружается одним запросом и кэшируется на объекте запроса, чтобы все
+    сериализаторы, отдающие is_subscribed, не ходили в базу для каждой строки.
+    """
+    if not request.user.is_authenticated:
+        return frozenset()
+    author_ids = getattr(request, '_subscribed_author_ids', None)
+    if author_ids is None:
+        author_ids = frozenset(Subscription.objects.filter(
+            user=request.user).values_list('author_id', flat=True))
+        request._subscribed_author_ids = author_ids
+    return author_ids
+
+
+def get_recipes_limit(request):
+    """Значение параметра recipes_limit или None, если он не задан"""
+    try:
+        recipes_limit = int(request.query_params.get('recipes_limit'))
+    except (TypeError, ValueError):
+        return None
+    return recipes_limit if recipes_limit >= 0 else None
+
+
+def get_int_param(request, name):
+    """Целое значение параметра name или None, если он не задан"""
+    try:
+        return int(request.query_params.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_int_params(request, name):
+    """Целые значения повторяющегося параметра name, прочие пропускаются"""
+    return [
+        int(value) for value in request.query_params.getlist(name)
+        if value.isdigit()
+    ]
+
+
+@lru_cache(maxsize=None)
+def register_fonts():
+    """Шрифт читается и регистрируется один раз на процесс"""
+    pdfmetrics.registerFont(
+        TTFont('Arial', os.path.join(settings.BASE_DIR, 'data', 'arial.ttf'))
+    )
+
+
+def get_shopping_list_version(shopping_list):
+    """Версия списка покупок - хэш его содержимого"""
+    return hashlib.sha1(
+        repr([tuple(item) for item in shopping_list]).encode()
+    ).hexdigest()
+
+
+def get_shopping_list_pdf_key(user, version):
+    return f'shopping_list_pdf:{user.pk}:{version}'
+
+
+def get_cached_shopping_list_pdf(shopping_list, user, version, render=True):
+    """PDF списка покупок из кэша или свежесобранный.
+
+    С render=False возвращает None, если PDF этой версии ещё нет в кэше.
+    """
+    key = get_shopping_list_pdf_key(user, version)
+    pdf = cache.get(key)
+    if pdf is None and render:
+        pdf = generate_shopping_list_pdf(shopping_list, user).getvalue()
+        cache.set(key, pdf, settings.SHOPPING_LIST_PDF_CACHE_TIMEOUT)
+    return pdf
+
+
 def generate_shopping_list_pdf(shopping_list, user):
 
     def header_footer(canvas, doc):
@@ -32,9 +115,7 @@ def generate_shopping_list_pdf(shopping_list, user):
 
         canvas.restoreState()
 
-    pdfmetrics.registerFont(
-        TTFont('Arial', 'data/arial.ttf')
-    )
+    register_fonts()
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, title='Shopping List')
 
@@ -66,14 +147,70 @@ ShoppingListItem = namedtuple('ShoppingListItem',
                               ['name', 'amount', 'measurement_unit'])
 
 
-def process_shopping_list(recipe_list):
-    ingredients = {}
-    for recipe in recipe_list:
-        for _ in recipe.recipe_ingredients.select_related('ingredient').all():
-            key = (_.ingredient.name, _.ingredient.measurement_unit)
-            if key not in ingredients:
-                ingredients[key] = 0
-            ingredients[key] += _.amount
+def get_shopping_list_rows(user):
+    """Строки (name, amount, measurement_unit) списка покупок"""
+    return ShoppingListIngredient.objects.filter(
+        user=user, amount__gt=0
+    ).values_list(
+        'ingredient__name', 'amount', 'ingredient__measurement_unit'
+    ).order_by('ingredient__name', 'ingredient__measurement_unit')
+
+
+def process_shopping_list(user):
+    """Список покупок из материализованной таблицы ShoppingListIngredient"""
+    return [ShoppingListItem(*row) for row in get_shopping_list_rows(user)]
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает записанную строку"""
+    def write(self, value):
+        return value
+
+
+def iter_shopping_list_txt(rows):
+    for name, amount, measurement_unit in rows:
+        yield f'{name} ({measurement_unit}) - {amount}\n'
+
+
+def iter_shopping_list_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(['name', 'amount', 'measurement_unit'])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_shopping_list_json(rows):
+    yield '['
+    for index, (name, amount, measurement_unit) in enumerate(rows):
+        yield (',' if index else '') + json.dumps({
+            'name': name,
+            'amount': amount,
+            'measurement_unit': measurement_unit,
+        }, ensure_ascii=False)
+    yield ']'
+
+
+SHOPPING_LIST_STREAM_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', iter_shopping_list_txt),
+    'csv': ('text/csv; charset=utf-8', iter_shopping_list_csv),
+    'json': ('application/json; charset=utf-8', iter_shopping_list_json),
+}
+
+SHOPPING_LIST_MEDIA_TYPES = {
+    'application/pdf': 'pdf',
+    'text/plain': 'txt',
+    'text/csv': 'csv',
+    'application/json': 'json',
+}
+
 
-    return [ShoppingListItem(name, amount, measurement_unit)
-            for ((name, measurement_unit), amount) in ingredients.items()]
+def get_shopping_list_format(request, default='pdf'):
+    """Формат из параметра file_ext или заголовка Accept"""
+    file_ext = request.query_params.get('file_ext')
+    if file_ext:
+        return file_ext.lower()
+    for media_type in request.headers.get('Accept', '').split(','):
+        media_type = media_type.split(';')[0].strip().lower()
+        if media_type in SHOPPING_LIST_MEDIA_TYPES:
+            return SHOPPING_LIST_MEDIA_TYPES[media_type]
+    return default
@@ -1,32 +1,89 @@
 # api/view.py
-from datetime import date
-
-from django.http import FileResponse
+from django.conf import settings
+from django.db.models import OuterRef, Prefetch, Subquery
+from django.db.transaction import atomic
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
 from djoser.serializers import SetPasswordSerializer
 from djoser.views import UserViewSet
-from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from recipes.models import (
+    Favorite, Ingredient, Recipe, ShoppingCart, ShoppingListExport,
+    ShoppingListIngredient, Tag, TimelineEntry, set_user_flags,
+)
+from recipes.relations import add_relations, remove_relation, remove_relations
+from recipes.versions import INGREDIENTS, TAGS
 from rest_framework import filters, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from users.models import CustomUser, Subscription
 
+from .caching import versioned_response
+from .filters import RecipeSearchFilter
+from .pagination import (
+    FeedCursorPagination, RecipeCursorPagination, SubscriptionCursorPagination,
+    get_paginator,
+)
+from .search import ingredient_index
 from .serializers import (
-    CustomUserSerializer, CustomUserSignUpSerializer, FavoriteCreteSerializer,
-    IngredientSerializer, RecipeCreateSerializer, RecipeMinifiedSerializer,
-    RecipeSerializer, ShoppingCartCreateSerializer,
-    SubscriptionCreateSerializer, SubscriptionSerializer, TagSerializer,
+    BulkRelationSerializer, CustomUserSerializer, CustomUserSignUpSerializer,
+    FavoriteCreteSerializer, IngredientSerializer, RecipeCreateSerializer,
+    RecipeMinifiedSerializer, RecipeSerializer, ShoppingCartCreateSerializer,
+    ShoppingListExportSerializer, SubscriptionCreateSerializer,
+    SubscriptionSerializer, TagSerializer, relation_error,
 )
+from .tasks import submit_shopping_list_export, submit_timeline_refill
 from .utils import (
-    IsAuthenticatedOrReadOnly, generate_shopping_list_pdf,
-    process_shopping_list,
+    SHOPPING_LIST_STREAM_FORMATS, IsAuthenticatedOrReadOnly,
+    get_cached_shopping_list_pdf, get_int_param, get_int_params,
+    get_recipes_limit, get_shopping_list_format, get_shopping_list_rows,
+    get_shopping_list_version, process_shopping_list,
 )
 
 
+def bulk_relations(request, model, field_name, targets, adding,
+                   on_change=None):
+    """Пакетно добавляет или удаляет связи пользователя с объектами targets.
+
+    Существование объектов проверяется одним запросом, изменения
+    применяются одной транзакцией; в ответе статус для каждого id.
+    """
+    serializer = BulkRelationSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    ids = serializer.validated_data['ids']
+    values = {'user': request.user}
+    if adding:
+        found = set(targets.filter(pk__in=ids).values_list('pk', flat=True))
+        with atomic():
+            changed = add_relations(model, values, field_name,
+                                    [pk for pk in ids if pk in found])
+            if changed and on_change:
+                on_change(request.user, changed)
+        statuses = {pk: 'added' if pk in changed else 'exists'
+                    for pk in found}
+    else:
+        with atomic():
+            changed = remove_relations(model, values, field_name, ids)
+            if changed and on_change:
+                on_change(request.user, changed)
+        statuses = dict.fromkeys(changed, 'removed')
+    return Response({'results': [
+        {'id': pk, 'status': statuses.get(pk, 'not_found')} for pk in ids
+    ]})
+
+
+def unfollowed(user, author_ids):
+    """Ленты после отписки user от авторов author_ids"""
+    TimelineEntry.objects.prune(user, author_ids)
+    submit_timeline_refill(author_ids)
+
+
 class CustomUserViewSet(UserViewSet):
     """ViewSet модели пользователей"""
     queryset = CustomUser.objects.all()
@@ -40,12 +97,10 @@ class CustomUserViewSet(UserViewSet):
             return CustomUserSignUpSerializer
         return CustomUserSerializer
 
-    def get_subscribed_recipes(self, user):
-        subscribed_users = user.following.all()
-        subscribed_recipes = Recipe.objects.filter(
-            author__in=subscribed_users,
-            pub_date__lte=date.today())
-        return subscribed_recipes
+    def get_instance(self):
+        # request.user берётся из кэша аутентификации, для /users/me/
+        # нужна актуальная запись
+        return CustomUser.objects.get(pk=self.request.user.pk)
 
     def paginate_and_serialize(self, queryset):
         page = self.paginate_queryset(queryset)
@@ -85,7 +140,9 @@ class CustomUserViewSet(UserViewSet):
 
             if self.request.user.check_password(current_password):
                 self.request.user.set_password(new_password)
-                self.request.user.save()
+                # Только пароль: request.user может быть из кэша
+                # аутентификации с устаревшими счётчиками
+                self.request.user.save(update_fields=['password'])
                 return Response(status=204)
             else:
                 return Response({'detail': 'Пароли не совпадают.'},
@@ -133,9 +190,22 @@ class SubscriptionViewSet(viewsets.ViewSet):
     @action(detail=False, methods=['get'], url_path='subscriptions',
             url_name='list_subscriptions')
     def list_subscriptions(self, request):
+        recipes = Recipe.objects.all()
+        recipes_limit = get_recipes_limit(request)
+        if recipes_limit is not None:
+            # Не более recipes_limit последних рецептов каждого автора
+            recipes = recipes.filter(pk__in=Subquery(
+                Recipe.objects.filter(
+                    author=OuterRef('author')
+                ).order_by('-pub_date').values('pk')[:recipes_limit]
+            ))
         queryset = Subscription.objects.filter(
-            user=request.user).order_by('-pk')
-        paginator = PageNumberPagination()
+            user=request.user
+        ).select_related('author').prefetch_related(
+            Prefetch('author__recipes', queryset=recipes,
+                     to_attr='latest_recipes')
+        ).order_by('-pk')
+        paginator = get_paginator(request, SubscriptionCursorPagination)
         paginated_queryset = paginator.paginate_queryset(queryset, request)
         serializer = self.get_serializer(paginated_queryset,
                                          context={'request': request},
@@ -159,15 +229,30 @@ class SubscriptionViewSet(viewsets.ViewSet):
     @action(detail=True, methods=['delete'], url_path='subscribe',
             url_name='unsubscribe')
     def unsubscribe(self, request, pk=None):
-        target_user = self.get_user(pk)
-        serializer = SubscriptionCreateSerializer(
-            data={'author': target_user.id}, context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        subscription = Subscription.objects.get(
-            user=request.user, author=target_user)
-        subscription.delete()
+        with atomic():
+            if not remove_relation(Subscription, user=request.user,
+                                   author_id=pk):
+                # Несуществующий автор - 404, как до remove_relation
+                self.get_user(pk)
+                raise relation_error('Подписка не найдена')
+            unfollowed(request.user, [pk])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['post'], url_path='subscribe/bulk',
+            url_name='subscribe_bulk')
+    def subscribe_bulk(self, request):
+        return bulk_relations(
+            request, Subscription, 'author',
+            CustomUser.objects.exclude(pk=request.user.pk), adding=True,
+            on_change=TimelineEntry.objects.backfill)
+
+    @action(detail=False, methods=['delete'], url_path='subscribe/bulk',
+            url_name='unsubscribe_bulk')
+    def unsubscribe_bulk(self, request):
+        return bulk_relations(request, Subscription, 'author',
+                              CustomUser.objects.all(), adding=False,
+                              on_change=unfollowed)
+
 
 class TagViewSet(ModelViewSet):
     """ViewSet модели тегов"""
@@ -177,17 +262,17 @@ class TagViewSet(ModelViewSet):
     pagination_class = None
 
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        return versioned_response(
+            request, TAGS, ('detail', kwargs.get('pk')),
+            lambda: self.get_serializer(self.get_object()).data)
 
 
 class TagListView(APIView):
     """Представление для получения списка тегов"""
     def get(self, request):
-        tags = Tag.objects.all()
-        serializer = TagSerializer(tags, many=True)
-        return Response(serializer.data)
+        return versioned_response(
+            request, TAGS, ('list',),
+            lambda: TagSerializer(Tag.objects.all(), many=True).data)
 
 
 class IngredientViewSet(ModelViewSet):
@@ -197,36 +282,53 @@ class IngredientViewSet(ModelViewSet):
     pagination_class = None
 
     def get_queryset(self):
-        query = self.request.query_params.get('name', '')
-        queryset = Ingredient.objects.filter(name__icontains=query)
-        return queryset
+        return Ingredient.objects.all()
+
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get('name', '')
+        if not query:
+            return versioned_response(
+                request, INGREDIENTS, ('list',),
+                lambda: self.get_serializer(
+                    self.get_queryset(), many=True).data)
+        return versioned_response(
+            request, INGREDIENTS, ('search', query.casefold()),
+            lambda: ingredient_index.search(
+                query, settings.INGREDIENT_SEARCH_LIMIT))
+
+    def retrieve(self, request, *args, **kwargs):
+        return versioned_response(
+            request, INGREDIENTS, ('detail', kwargs.get('id')),
+            lambda: self.get_serializer(self.get_object()).data)
 
 
 class RecipeViewSet(ModelViewSet):
     """ViewSet модели рецептов"""
     queryset = Recipe.objects.all()
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [filters.OrderingFilter, RecipeSearchFilter]
+    ordering_fields = ('pub_date', 'favorites_count', 'in_carts_count',
+                       'cooking_time')
+    ordering = ('-pub_date', '-id')
     http_method_names = ['get', 'post', 'put', 'patch', 'delete']
 
-    """
-    def dispatch(self, request, *args, **kwargs):
-        Логи запросов к db
-        res = super().dispatch(request, *args, **kwargs)
-
-        from django.db import connection
-        print(len(connection.queries))
-        for q in connection.queries:
-            print('>>>>', q['sql'])
-
-        return res
-    """
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = get_paginator(
+                self.request,
+                FeedCursorPagination if self.action == 'feed'
+                else RecipeCursorPagination)
+        return self._paginator
+
+    def optimize_queryset(self, queryset):
+        return queryset.select_related('author').prefetch_related(
+            'recipe_ingredients__ingredient', 'tags'
+        )
 
     def get_queryset(self):
         """Оптимизация запросов"""
-        queryset = Recipe.objects.select_related('author').prefetch_related(
-            'recipe_ingredients__ingredient', 'tags'
-        )
+        queryset = self.optimize_queryset(Recipe.objects.all())
 
         # Фильтрация по автору
         author_id = self.request.query_params.get('author', None)
@@ -236,30 +338,53 @@ class RecipeViewSet(ModelViewSet):
         # Фильтрация по тегам
         tags = self.request.query_params.getlist('tags', [])
         if tags:
-            queryset = queryset.filter(tags__slug__in=tags).distinct()
-
-        # Фильтрация по избранным
-        is_favorited = self.request.query_params.get('is_favorited', None)
-        if is_favorited is not None:
-            favorited_recipes_ids = self.request.user.favorites_user.all(
-            ).values_list('recipe_id', flat=True)
-            queryset = queryset.filter(id__in=favorited_recipes_ids)\
-                if int(is_favorited)\
-                else queryset.exclude(id__in=favorited_recipes_ids)
-
-        # Фильтрация по корзине покупок
-        is_in_shopping_cart = self.request.query_params.get(
-            'is_in_shopping_cart', None)
-        if is_in_shopping_cart is not None:
-            shopping_cart_recipe_ids = self.request.user.shopping_cart.all(
-            ).values_list('recipe_id', flat=True)
-            queryset = queryset.filter(id__in=shopping_cart_recipe_ids)\
-                if int(is_in_shopping_cart)\
-                else queryset.exclude(
-                id__in=shopping_cart_recipe_ids)
+            match_all = self.request.query_params.get('tags_mode') == 'all'
+            # Теги без бита (bulk_create) в маски не входят, как и в facets
+            tag_objects = list(
+                Tag.objects.filter(slug__in=tags).exclude(bit=None))
+            if match_all and len(tag_objects) < len(set(tags)):
+                queryset = queryset.none()
+            else:
+                queryset = queryset.with_tags(tag_objects, match_all)
+
+        # Фильтрация по времени приготовления
+        cooking_time_min = get_int_param(self.request, 'cooking_time_min')
+        if cooking_time_min is not None:
+            queryset = queryset.filter(cooking_time__gte=cooking_time_min)
+        cooking_time_max = get_int_param(self.request, 'cooking_time_max')
+        if cooking_time_max is not None:
+            queryset = queryset.filter(cooking_time__lte=cooking_time_max)
+
+        # Фильтрация по ингредиентам
+        include = get_int_params(self.request, 'ingredients')
+        exclude = get_int_params(self.request, 'exclude_ingredients')
+        if include or exclude:
+            queryset = queryset.with_ingredients(include, exclude)
+
+        # Фильтрация по избранным и корзине покупок
+        flags = {
+            name: bool(int(self.request.query_params[name]))
+            for name in ('is_favorited', 'is_in_shopping_cart')
+            if name in self.request.query_params
+        }
+        if flags:
+            queryset = queryset.filter_user_flags(self.request.user, **flags)
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = set_user_flags(self.paginate_queryset(queryset),
+                              request.user)
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        if request.query_params.get('facets') in ('1', 'true'):
+            # Фасеты учитывают все активные фильтры
+            response.data['facets'] = queryset.facets(
+                Tag.objects.exclude(bit=None),
+                settings.COOKING_TIME_BUCKETS)
+        return response
+
     @action(detail=True, methods=['post'], url_path='favorite',
             url_name='add_favorite', permission_classes=[IsAuthenticated])
     def add_favorite(self, request, pk=None):
@@ -275,13 +400,8 @@ class RecipeViewSet(ModelViewSet):
     @action(detail=True, methods=['delete'], url_path='favorite',
             url_name='remove_favorite', permission_classes=[IsAuthenticated])
     def remove_favorite(self, request, pk=None):
-        serializer = FavoriteCreteSerializer(data={'recipe': pk},
-                                             context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        favorite = Favorite.objects.get(
-            user=request.user,
-            recipe=serializer.validated_data['recipe'])
-        favorite.delete()
+        if not remove_relation(Favorite, user=request.user, recipe_id=pk):
+            raise relation_error('Рецепт не найден в избранных')
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=["post"], url_path='shopping_cart',
@@ -303,16 +423,59 @@ class RecipeViewSet(ModelViewSet):
             url_name='remove_from_shopping_cart',
             permission_classes=[IsAuthenticated])
     def remove_shopping_cart(self, request, pk=None):
-        serializer = ShoppingCartCreateSerializer(
-            data={'recipe': pk},
-            context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        favorite = ShoppingCart.objects.get(
-            user=request.user,
-            recipe=serializer.validated_data['recipe'])
-        favorite.delete()
+        with atomic():
+            if not remove_relation(ShoppingCart, user=request.user,
+                                   recipe_id=pk):
+                raise relation_error('Рецепт не найден в корзине')
+            ShoppingListIngredient.objects.remove_recipe(request.user, pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    # Без OrderingFilter курсор берёт порядок из FeedCursorPagination,
+    # а ?ordering= не действует на ленту
+    @action(detail=False, methods=['get'], url_path='feed',
+            url_name='feed', permission_classes=[IsAuthenticated],
+            filter_backends=[])
+    def feed(self, request):
+        """Лента рецептов авторов из подписок"""
+        queryset = self.optimize_queryset(
+            TimelineEntry.objects.feed(request.user)
+        ).order_by('-feed_date', '-id')
+        page = set_user_flags(self.paginate_queryset(queryset),
+                              request.user)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['post'], url_path='favorite/bulk',
+            url_name='add_favorite_bulk', permission_classes=[IsAuthenticated])
+    def add_favorite_bulk(self, request):
+        return bulk_relations(request, Favorite, 'recipe',
+                              Recipe.objects.all(), adding=True)
+
+    @action(detail=False, methods=['delete'], url_path='favorite/bulk',
+            url_name='remove_favorite_bulk',
+            permission_classes=[IsAuthenticated])
+    def remove_favorite_bulk(self, request):
+        return bulk_relations(request, Favorite, 'recipe',
+                              Recipe.objects.all(), adding=False)
+
+    @action(detail=False, methods=['post'], url_path='shopping_cart/bulk',
+            url_name='add_to_shopping_cart_bulk',
+            permission_classes=[IsAuthenticated])
+    def add_shopping_cart_bulk(self, request):
+        return bulk_relations(
+            request, ShoppingCart, 'recipe', Recipe.objects.all(),
+            adding=True,
+            on_change=ShoppingListIngredient.objects.add_recipes)
+
+    @action(detail=False, methods=['delete'], url_path='shopping_cart/bulk',
+            url_name='remove_from_shopping_cart_bulk',
+            permission_classes=[IsAuthenticated])
+    def remove_shopping_cart_bulk(self, request):
+        return bulk_relations(
+            request, ShoppingCart, 'recipe', Recipe.objects.all(),
+            adding=False,
+            on_change=ShoppingListIngredient.objects.remove_recipes)
+
     def get_serializer_class(self):
         if self.action == 'create':
             return RecipeCreateSerializer
@@ -322,7 +485,6 @@ class RecipeViewSet(ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
-        self.request.user.save()
 
 
 class ShoppingCartViewSet(viewsets.ViewSet):
@@ -330,25 +492,80 @@ class ShoppingCartViewSet(viewsets.ViewSet):
     serializer_class = RecipeMinifiedSerializer
     pagination_class = None
 
+    def perform_content_negotiation(self, request, force=False):
+        # Формат файла выбирается в get_shopping_list_format, а не рендерером
+        return super().perform_content_negotiation(request, force=True)
+
     @action(detail=True, methods=['get'], url_path='shopping_cart',
             url_name='download_shopping_cart',
             permission_classes=[IsAuthenticated])
-    def download_shopping_cart(self, request, file_ext='pdf'):
+    def download_shopping_cart(self, request, file_ext=None):
         user = request.user
-        current_user_shopping_list = Recipe.objects.filter(
-            shopping_cart__user=user)
-        shopping_list_items = process_shopping_list(current_user_shopping_list)
-
-        if file_ext == 'pdf':
-            content_type = 'application/pdf'
-            buffer = generate_shopping_list_pdf(shopping_list_items, user)
+        if file_ext is None:
+            file_ext = get_shopping_list_format(request)
+
+        if file_ext in SHOPPING_LIST_STREAM_FORMATS:
+            content_type, stream = SHOPPING_LIST_STREAM_FORMATS[file_ext]
+            response = StreamingHttpResponse(
+                stream(get_shopping_list_rows(user).iterator()),
+                content_type=content_type)
+        elif file_ext == 'pdf':
+            shopping_list_items = process_shopping_list(user)
+            version = get_shopping_list_version(shopping_list_items)
+            etag = quote_etag(version)
+            if_none_match = parse_etags(
+                request.headers.get('If-None-Match', ''))
+            if etag in if_none_match or '*' in if_none_match:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+            threshold = settings.SHOPPING_LIST_ASYNC_THRESHOLD
+            content = get_cached_shopping_list_pdf(
+                shopping_list_items, user, version,
+                render=not threshold or len(shopping_list_items) <= threshold)
+            if content is None:
+                # Большой список собирается в фоне
+                return self.start_export(request, version)
+            response = HttpResponse(content, content_type='application/pdf')
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
         else:
             return Response(
                 {'detail': 'Недопустимый формат файла.'},
                 status=status.HTTP_400_BAD_REQUEST)
 
-        response = FileResponse(buffer, content_type=content_type)
         filename = f'{user.username}_shopping_cart.{file_ext}'
         response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
         return response
+
+    def start_export(self, request, version):
+        ShoppingListExport.objects.expire(request.user)
+        export = ShoppingListExport.objects.reusable(request.user, version)
+        if export is None:
+            export = ShoppingListExport.objects.create(user=request.user,
+                                                       version=version)
+            submit_shopping_list_export(export)
+        location = request.build_absolute_uri(reverse(
+            'api:shopping_cart_export', kwargs={'pk': export.pk}))
+        return Response(ShoppingListExportSerializer(export).data,
+                        status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': location})
+
+    def create_export(self, request):
+        shopping_list_items = process_shopping_list(request.user)
+        return self.start_export(
+            request, get_shopping_list_version(shopping_list_items))
+
+    def retrieve_export(self, request, pk=None):
+        export = get_object_or_404(ShoppingListExport, pk=pk,
+                                   user=request.user)
+        if export.status == ShoppingListExport.DONE:
+            filename = f'{request.user.username}_shopping_cart.pdf'
+            return FileResponse(export.file.open('rb'), as_attachment=True,
+                                filename=filename,
+                                content_type='application/pdf')
+        if export.status == ShoppingListExport.FAILED:
+            return Response(ShoppingListExportSerializer(export).data)
+        return Response(ShoppingListExportSerializer(export).data,
+                        status=status.HTTP_202_ACCEPTED)
@@ -41,6 +41,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Профилирование запросов (Server-Timing и лог), по умолчанию выключено
+if os.getenv('REQUEST_PROFILING') == 'True':
+    MIDDLEWARE.insert(0, 'api.middleware.RequestProfilingMiddleware')
+
+# Порог числа SQL-запросов на один HTTP-запрос для предупреждения в логе
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', default=20))
+
 ROOT_URLCONF = 'foodgram.urls'
 
 TEMPLATES = [
@@ -72,6 +79,18 @@ DATABASES = {
     }
 }
 
+# LocMemCache у каждого процесса свой. При нескольких воркерах нужен
+# общий бэкенд (CACHE_BACKEND), иначе версии справочников и сброс
+# кэша токенов не доходят до других процессов
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default='foodgram'),
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -102,6 +121,62 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 CSV_DIR = os.path.join(BASE_DIR, 'data')
 
+# Кэш справочников (теги, ингредиенты), секунды
+REFERENCE_CACHE_TIMEOUT = int(
+    os.getenv('REFERENCE_CACHE_TIMEOUT', default=24 * 60 * 60))
+REFERENCE_CACHE_MAX_AGE = int(
+    os.getenv('REFERENCE_CACHE_MAX_AGE', default=0))
+
+# Срок жизни версии справочных данных, секунды (0 - бессрочно). С общим
+# кэшем версия бессрочна; с LocMemCache срок ограничивает, как долго
+# процесс не видит bump_data_version из другого процесса
+DATA_VERSION_TIMEOUT = int(os.getenv(
+    'DATA_VERSION_TIMEOUT',
+    default=0 if os.getenv('CACHE_BACKEND') else 60)) or None
+
+INGREDIENT_SEARCH_LIMIT = int(
+    os.getenv('INGREDIENT_SEARCH_LIMIT', default=50))
+
+SHOPPING_LIST_PDF_CACHE_TIMEOUT = int(
+    os.getenv('SHOPPING_LIST_PDF_CACHE_TIMEOUT', default=60 * 60))
+
+# Списки покупок длиннее порога (в ингредиентах) собираются в фоне,
+# 0 - всегда синхронно
+SHOPPING_LIST_ASYNC_THRESHOLD = int(
+    os.getenv('SHOPPING_LIST_ASYNC_THRESHOLD', default=0))
+SHOPPING_LIST_EXPORT_WORKERS = int(
+    os.getenv('SHOPPING_LIST_EXPORT_WORKERS', default=2))
+# Фоновая выгрузка старше этого срока (секунды) считается потерянной:
+# очередь в памяти процесса пропадает при его перезапуске
+SHOPPING_LIST_EXPORT_TIMEOUT = int(
+    os.getenv('SHOPPING_LIST_EXPORT_TIMEOUT', default=10 * 60))
+# Сколько хранятся выгрузки и их файлы, секунды
+SHOPPING_LIST_EXPORT_TTL = int(
+    os.getenv('SHOPPING_LIST_EXPORT_TTL', default=24 * 60 * 60))
+
+# Кэш token -> user: общий и в памяти процесса, секунды. После выхода
+# или смены пароля другие процессы принимают токен ещё не дольше
+# TOKEN_LOCAL_CACHE_TIMEOUT. Без общего бэкенда (CACHE_BACKEND) общий
+# слой по умолчанию выключен (0): с LocMemCache он свой у каждого
+# процесса и сброс токена до других процессов не доходит
+TOKEN_CACHE_TIMEOUT = int(os.getenv(
+    'TOKEN_CACHE_TIMEOUT',
+    default=5 * 60 if os.getenv('CACHE_BACKEND') else 0))
+TOKEN_LOCAL_CACHE_TIMEOUT = int(
+    os.getenv('TOKEN_LOCAL_CACHE_TIMEOUT', default=15))
+
+# Рецепты авторов с большим числом подписчиков не раскладываются
+# по лентам, а дочитываются при запросе ленты
+TIMELINE_FANOUT_LIMIT = int(
+    os.getenv('TIMELINE_FANOUT_LIMIT', default=1000))
+
+# Границы интервалов cooking_time (минуты) для фасетов списка рецептов
+COOKING_TIME_BUCKETS = (15, 30, 60, 120)
+
+# Максимум id в одном пакетном запросе избранного/корзины/подписок
+BULK_RELATIONS_LIMIT = int(
+    os.getenv('BULK_RELATIONS_LIMIT', default=100))
+
 MEDIA_URL = '/backend_media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
@@ -111,10 +186,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'users.CustomUser'
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.LimitPageNumberPagination',
     'PAGE_SIZE': 6,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        "rest_framework.authentication.TokenAuthentication",
+        "api.authentication.CachedTokenAuthentication",
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
@@ -144,5 +219,10 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'api': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     },
 }
@@ -0,0 +1,52 @@
+# recipes/counters.py
+"""Денормализованные счётчики и их сверка с исходными таблицами"""
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from users.models import CustomUser, Subscription
+
+from .models import Favorite, Recipe, ShoppingCart
+
+# (модель, поле счётчика, связанная модель, внешний ключ на модель)
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (CustomUser, 'recipes_count', Recipe, 'author'),
+    (CustomUser, 'followers_count', Subscription, 'author'),
+)
+
+
+def change_counter(model, pk, field, delta):
+    """Атомарно изменяет счётчик на delta одним UPDATE"""
+    model.objects.filter(pk=pk).update(**{field: F(field) + delta})
+
+
+def actual_count(related_model, foreign_key):
+    return Coalesce(
+        Subquery(
+            related_model.objects.filter(
+                **{foreign_key: OuterRef('pk')}
+            ).order_by().values(foreign_key).annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def reconcile_counters(fix=True):
+    """Находит и (при fix=True) исправляет расхождения счётчиков.
+
+    Возвращает {(модель, поле): количество строк с расхождением}.
+    """
+    drift = {}
+    for model, field, related_model, foreign_key in COUNTERS:
+        drifted = model.objects.annotate(
+            actual=actual_count(related_model, foreign_key)
+        ).exclude(**{field: F('actual')})
+        drifted_ids = list(drifted.values_list('pk', flat=True))
+        drift[(model.__name__, field)] = len(drifted_ids)
+        if fix and drifted_ids:
+            model.objects.filter(pk__in=drifted_ids).update(
+                **{field: actual_count(related_model, foreign_key)})
+    return drift
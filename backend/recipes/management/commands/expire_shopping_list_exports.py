@@ -0,0 +1,12 @@
+# recipes/management/commands/expire_shopping_list_exports.py
+from django.core.management.base import BaseCommand
+from recipes.models import ShoppingListExport
+
+
+class Command(BaseCommand):
+    help = ('Отметка зависших выгрузок списков покупок ошибкой и удаление '
+            'выгрузок старше SHOPPING_LIST_EXPORT_TTL вместе с файлами')
+
+    def handle(self, *args, **options):
+        stale, deleted = ShoppingListExport.objects.expire()
+        self.stdout.write(f'Зависших выгрузок: {stale}, удалено: {deleted}')
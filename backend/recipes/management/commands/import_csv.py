@@ -4,6 +4,7 @@ import csv
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from recipes.models import Ingredient
+from recipes.versions import INGREDIENTS, bump_data_version
 
 ModelsCSV = {
     Ingredient: 'ingredients.csv',
@@ -33,6 +34,7 @@ class Command(BaseCommand):
                         'Неверный формат файла: неправильные заголовки полей.')
 
                 model.objects.bulk_create(model(**data) for data in reader)
+            bump_data_version(INGREDIENTS)
             self.stdout.write(
                 f'Завершен импорт данных в модель {model.__name__}'
             )
@@ -0,0 +1,18 @@
+# recipes/management/commands/rebuild_recipe_search.py
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic
+from recipes.models import Recipe
+from recipes.search import update_recipe_search
+
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Пересборка полнотекстового индекса рецептов'
+
+    def handle(self, *args, **options):
+        recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+        for start in range(0, len(recipe_ids), CHUNK_SIZE):
+            with atomic():
+                update_recipe_search(recipe_ids[start:start + CHUNK_SIZE])
+        self.stdout.write(f'Проиндексировано рецептов: {len(recipe_ids)}')
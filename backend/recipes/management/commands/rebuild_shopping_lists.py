@@ -0,0 +1,45 @@
+# recipes/management/commands/rebuild_shopping_lists.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from recipes.models import ShoppingListIngredient
+
+
+class Command(BaseCommand):
+    help = 'Пересборка и проверка материализованных списков покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сравнить списки покупок с корзинами',
+        )
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            dest='user_ids',
+            help='id пользователя (можно указать несколько раз)',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if not options['check']:
+            with atomic():
+                ShoppingListIngredient.objects.rebuild(user_ids)
+            self.stdout.write('Списки покупок пересобраны')
+
+        expected = ShoppingListIngredient.objects.expected_amounts(user_ids)
+        actual = ShoppingListIngredient.objects.actual_amounts(user_ids)
+        mismatches = {
+            key for key in expected.keys() | actual.keys()
+            if expected.get(key, 0) != actual.get(key, 0)
+        }
+        for user_id, ingredient_id in sorted(mismatches):
+            self.stdout.write(
+                f'user={user_id} ingredient={ingredient_id}: '
+                f'ожидалось {expected.get((user_id, ingredient_id), 0)}, '
+                f'в списке {actual.get((user_id, ingredient_id), 0)}'
+            )
+        if mismatches:
+            raise CommandError(f'Расхождений: {len(mismatches)}')
+        self.stdout.write('Списки покупок совпадают с корзинами')
@@ -0,0 +1,23 @@
+# recipes/management/commands/rebuild_timelines.py
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic
+from recipes.models import TimelineEntry
+
+
+class Command(BaseCommand):
+    help = ('Пересборка лент подписок '
+            '(например, после изменения TIMELINE_FANOUT_LIMIT)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            dest='user_ids',
+            help='id пользователя (можно указать несколько раз)',
+        )
+
+    def handle(self, *args, **options):
+        with atomic():
+            TimelineEntry.objects.rebuild(options['user_ids'])
+        self.stdout.write('Ленты подписок пересобраны')
@@ -0,0 +1,23 @@
+# recipes/management/commands/reconcile_counters.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from recipes.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Сверка и исправление денормализованных счётчиков'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только найти расхождения, не исправляя их',
+        )
+
+    def handle(self, *args, **options):
+        with atomic():
+            drift = reconcile_counters(fix=not options['check'])
+        for (model, field), count in drift.items():
+            self.stdout.write(f'{model}.{field}: расхождений {count}')
+        if options['check'] and any(drift.values()):
+            raise CommandError('Счётчики расходятся с данными')
@@ -0,0 +1,208 @@
+# recipes/management/commands/seed_load.py
+import random
+
+from itertools import accumulate, islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from recipes.counters import reconcile_counters
+from recipes.models import (
+    Favorite, Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+    ShoppingListIngredient, Tag, TimelineEntry,
+)
+from recipes.versions import INGREDIENTS, TAGS, bump_data_version
+from users.models import CustomUser, Subscription
+
+SEED_PASSWORD = 'seed-password'
+
+
+def power_law_weights(count, exponent):
+    """Накопленные веса 1 / rank^exponent для random.choices"""
+    return list(accumulate(
+        1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+class Command(BaseCommand):
+    help = ('Генерация синтетических данных для нагрузочного тестирования: '
+            'пользователи, рецепты, теги, избранное, корзины и подписки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--tags', type=int, default=10,
+                            help='Сколько тегов должно быть в базе')
+        parser.add_argument('--ingredients', type=int, default=500,
+                            help='Сколько ингредиентов создать, '
+                                 'если справочник пуст')
+        parser.add_argument('--recipe-ingredients', type=int, nargs=2,
+                            default=(3, 12), metavar=('MIN', 'MAX'))
+        parser.add_argument('--recipe-tags', type=int, nargs=2,
+                            default=(1, 3), metavar=('MIN', 'MAX'))
+        parser.add_argument('--following', type=int, default=20,
+                            help='Среднее число подписок пользователя')
+        parser.add_argument('--favorites', type=int, default=30,
+                            help='Среднее число избранных рецептов')
+        parser.add_argument('--cart', type=int, default=15,
+                            help='Среднее число рецептов в корзине')
+        parser.add_argument('--exponent', type=float, default=1.1,
+                            help='Показатель степенного распределения '
+                                 'популярности авторов и рецептов')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['recipes'] < 1:
+            raise CommandError('Нужен хотя бы один пользователь и рецепт')
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = f'seed{options["seed"]}'
+        if CustomUser.objects.filter(
+                username__startswith=f'{self.prefix}_').exists():
+            raise CommandError(
+                f'Данные с seed={options["seed"]} уже загружены')
+
+        tag_ids = self.create_tags(options['tags'])
+        ingredient_ids = self.create_ingredients(options['ingredients'])
+        user_ids = self.create_users(options['users'])
+        recipe_ids = self.create_recipes(
+            options['recipes'], user_ids, tag_ids, ingredient_ids, options)
+        author_weights = power_law_weights(len(user_ids),
+                                           options['exponent'])
+        recipe_weights = power_law_weights(len(recipe_ids),
+                                           options['exponent'])
+        self.create_relations(
+            Subscription, 'author_id', user_ids, user_ids, author_weights,
+            options['following'], exclude_self=True)
+        self.create_relations(
+            Favorite, 'recipe_id', user_ids, recipe_ids, recipe_weights,
+            options['favorites'])
+        self.create_relations(
+            ShoppingCart, 'recipe_id', user_ids, recipe_ids, recipe_weights,
+            options['cart'])
+
+        self.stdout.write('Пересчёт производных данных')
+        with atomic():
+            reconcile_counters(fix=True)
+            ShoppingListIngredient.objects.rebuild()
+            TimelineEntry.objects.rebuild()
+        call_command('rebuild_recipe_search', stdout=self.stdout)
+        self.stdout.write('Генерация данных завершена')
+
+    def bulk_create(self, model, objects):
+        """Вставка пачками по batch_size, возвращает число строк"""
+        objects = iter(objects)
+        total = 0
+        while True:
+            batch = list(islice(objects, self.batch_size))
+            if not batch:
+                break
+            with atomic():
+                model.objects.bulk_create(batch, batch_size=self.batch_size)
+            total += len(batch)
+        self.stdout.write(f'{model.__name__}: {total}')
+        return total
+
+    def new_ids(self, model, last_pk):
+        return list(model.objects.filter(
+            pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+
+    def last_pk(self, model):
+        last = model.objects.order_by('-pk').values_list('pk', flat=True)
+        return last.first() or 0
+
+    def create_tags(self, count):
+        # Теги создаются по одному: бит маски назначается в pre_save
+        existing = Tag.objects.count()
+        for index in range(existing, count):
+            Tag.objects.create(
+                name=f'Тег {index}', slug=f'{self.prefix}-tag-{index}',
+                color=f'#{self.rng.randrange(0x1000000):06x}')
+        bump_data_version(TAGS)
+        return list(Tag.objects.values_list('pk', flat=True))
+
+    def create_ingredients(self, count):
+        if not Ingredient.objects.exists():
+            self.bulk_create(Ingredient, (
+                Ingredient(name=f'ингредиент {index}',
+                           measurement_unit=self.rng.choice(('г', 'мл', 'шт')))
+                for index in range(count)
+            ))
+            bump_data_version(INGREDIENTS)
+        return list(Ingredient.objects.values_list('pk', flat=True))
+
+    def create_users(self, count):
+        # Хэш пароля считается один раз: это самая дорогая часть
+        password = make_password(SEED_PASSWORD)
+        last_pk = self.last_pk(CustomUser)
+        self.bulk_create(CustomUser, (
+            CustomUser(
+                username=f'{self.prefix}_{index}',
+                email=f'{self.prefix}_{index}@example.com',
+                first_name=f'Имя{index}', last_name=f'Фамилия{index}',
+                password=password,
+            )
+            for index in range(count)
+        ))
+        return self.new_ids(CustomUser, last_pk)
+
+    def create_recipes(self, count, user_ids, tag_ids, ingredient_ids,
+                       options):
+        rng = self.rng
+        author_weights = power_law_weights(len(user_ids),
+                                           options['exponent'])
+        masks = dict(Tag.objects.values_list('pk', 'bit'))
+        recipe_tags = []
+        last_pk = self.last_pk(Recipe)
+
+        def recipes():
+            for index in range(count):
+                low, high = options['recipe_tags']
+                tags = rng.sample(tag_ids, min(rng.randint(low, high),
+                                               len(tag_ids)))
+                recipe_tags.append(tags)
+                yield Recipe(
+                    author_id=rng.choices(user_ids,
+                                          cum_weights=author_weights)[0],
+                    name=f'Рецепт {index}',
+                    text=f'Описание рецепта {index}',
+                    cooking_time=min(int(rng.lognormvariate(3.4, 0.7)) + 1,
+                                     1440),
+                    tag_mask=sum(1 << masks[pk] for pk in tags),
+                )
+
+        self.bulk_create(Recipe, recipes())
+        recipe_ids = self.new_ids(Recipe, last_pk)
+        self.bulk_create(Recipe.tags.through, (
+            Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+            for recipe_id, tags in zip(recipe_ids, recipe_tags)
+            for tag_id in tags
+        ))
+        low, high = options['recipe_ingredients']
+        self.bulk_create(RecipeIngredient, (
+            RecipeIngredient(recipe_id=recipe_id, ingredient_id=ingredient_id,
+                             amount=rng.randint(1, 500))
+            for recipe_id in recipe_ids
+            for ingredient_id in rng.sample(
+                ingredient_ids,
+                min(rng.randint(low, high), len(ingredient_ids)))
+        ))
+        return recipe_ids
+
+    def create_relations(self, model, field, user_ids, target_ids, weights,
+                         mean, exclude_self=False):
+        """Связи пользователей с целями, популярность - степенной закон"""
+        rng = self.rng
+
+        def relations():
+            for user_id in user_ids:
+                size = min(int(rng.expovariate(1 / mean)) if mean else 0,
+                           len(target_ids))
+                targets = set(rng.choices(target_ids, cum_weights=weights,
+                                          k=size))
+                targets.discard(user_id if exclude_self else None)
+                for target_id in targets:
+                    yield model(user_id=user_id, **{field: target_id})
+
+        self.bulk_create(model, relations())
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_shopping_lists(apps, schema_editor):
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingListIngredient = apps.get_model('recipes',
+                                            'ShoppingListIngredient')
+    rows = RecipeIngredient.objects.filter(
+        recipe__shopping_cart__isnull=False
+    ).values_list(
+        'recipe__shopping_cart__user_id', 'ingredient_id'
+    ).annotate(total=models.Sum('amount')).order_by()
+    ShoppingListIngredient.objects.bulk_create(
+        ShoppingListIngredient(user_id=user_id, ingredient_id=ingredient_id,
+                               amount=total)
+        for user_id, ingredient_id, total in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0016_recipe_pub_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(default=0, verbose_name='Количество')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_lists', to='recipes.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ингредиент списка покупок',
+                'verbose_name_plural': 'Списки покупок',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='shoppinglistingredient',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredient'), name='unique_shopping_list_ingredient'),
+        ),
+        migrations.RunPython(fill_shopping_lists, migrations.RunPython.noop),
+    ]
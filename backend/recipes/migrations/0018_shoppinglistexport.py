@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0017_shoppinglistingredient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListExport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('version', models.CharField(blank=True, max_length=40, verbose_name='Версия списка покупок')),
+                ('file', models.FileField(blank=True, upload_to='shopping_lists/', verbose_name='Файл')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_exports', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Выгрузка списка покупок',
+                'verbose_name_plural': 'Выгрузки списков покупок',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:20
+
+from django.db import migrations
+
+from recipes.search import (
+    create_search_index, drop_search_index, update_recipe_search,
+)
+
+
+def create_index(apps, schema_editor):
+    create_search_index(schema_editor)
+    Recipe = apps.get_model('recipes', 'Recipe')
+    update_recipe_search(
+        Recipe.objects.values_list('id', flat=True),
+        using=schema_editor.connection,
+    )
+
+
+def drop_index(apps, schema_editor):
+    drop_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0018_shoppinglistexport'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
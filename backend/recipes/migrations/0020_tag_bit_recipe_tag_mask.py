@@ -0,0 +1,40 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:08
+
+from django.db import migrations, models
+
+
+def fill_tag_masks(apps, schema_editor):
+    Tag = apps.get_model('recipes', 'Tag')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    for bit, tag in enumerate(Tag.objects.order_by('id')):
+        tag.bit = bit
+        tag.save(update_fields=('bit',))
+    masks = {}
+    for recipe_id, bit in Recipe.tags.through.objects.values_list(
+            'recipe_id', 'tag__bit'):
+        masks[recipe_id] = masks.get(recipe_id, 0) | 1 << bit
+    Recipe.objects.bulk_update(
+        [Recipe(pk=recipe_id, tag_mask=mask)
+         for recipe_id, mask in masks.items()],
+        ['tag_mask'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0019_recipe_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='tag_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Маска тегов'),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, unique=True, verbose_name='Бит в маске тегов рецепта'),
+        ),
+        migrations.RunPython(fill_tag_masks, migrations.RunPython.noop),
+    ]
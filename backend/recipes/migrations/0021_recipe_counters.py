@@ -0,0 +1,57 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    CustomUser = apps.get_model('users', 'CustomUser')
+    Subscription = apps.get_model('users', 'Subscription')
+    counters = (
+        (Recipe, 'favorites_count', Favorite, 'recipe'),
+        (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+        (CustomUser, 'recipes_count', Recipe, 'author'),
+        (CustomUser, 'followers_count', Subscription, 'author'),
+    )
+    for model, field, related_model, foreign_key in counters:
+        model.objects.update(**{field: Coalesce(
+            Subquery(
+                related_model.objects.filter(
+                    **{foreign_key: OuterRef('pk')}
+                ).order_by().values(foreign_key).annotate(
+                    total=Count('pk')
+                ).values('total'),
+                output_field=models.IntegerField(),
+            ),
+            Value(0),
+        )})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0020_tag_bit_recipe_tag_mask'),
+        ('users', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В корзинах'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-pub_date'], name='recipe_favorites_count_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.3 on 2026-10-18 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0022_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['cooking_time'], name='recipe_cooking_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipeingredient',
+            index=models.Index(fields=['ingredient', 'recipe'], name='recipe_ingredient_lookup_idx'),
+        ),
+    ]
@@ -1,9 +1,18 @@
 # recipes/models.py
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from users.models import CustomUser
+from users.models import CustomUser, Subscription
+
+# Биты 0..62 знакового BigIntegerField
+MAX_TAGS = 63
 
 
 class Tag(models.Model):
@@ -21,6 +30,12 @@ class Tag(models.Model):
         max_length=200,
         unique=True,
     )
+    bit = models.PositiveSmallIntegerField(
+        verbose_name=_('Бит в маске тегов рецепта'),
+        unique=True,
+        null=True,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = _('Тег')
@@ -30,6 +45,129 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    def assign_bit(self):
+        """Назначает свободный бит; вызывается из pre_save (см. signals)"""
+        used = set(Tag.objects.exclude(bit=None).values_list(
+            'bit', flat=True))
+        free = [bit for bit in range(MAX_TAGS) if bit not in used]
+        if not free:
+            raise ValueError(f'Нельзя создать больше {MAX_TAGS} тегов')
+        self.bit = free[0]
+
+    @property
+    def mask(self):
+        # Тег из bulk_create ещё без бита и в маски рецептов не входит
+        if self.bit is None:
+            return 0
+        return 1 << self.bit
+
+
+def get_tags_mask(tags):
+    """Битовая маска набора тегов"""
+    mask = 0
+    for tag in tags:
+        mask |= tag.mask
+    return mask
+
+
+class RecipeQuerySet(models.QuerySet):
+    """QuerySet рецептов"""
+
+    def with_tags(self, tags, match_all=False):
+        """Фильтр по маске тегов без JOIN и DISTINCT"""
+        mask = get_tags_mask(tags)
+        queryset = self.alias(
+            tags_match=models.F('tag_mask').bitand(mask))
+        if match_all:
+            return queryset.filter(tags_match=mask)
+        return queryset.filter(tags_match__gt=0)
+
+    def with_ingredients(self, include=(), exclude=()):
+        """Рецепты со всеми ингредиентами include и без ингредиентов exclude"""
+        queryset = self
+        include = set(include)
+        if include:
+            queryset = queryset.filter(pk__in=RecipeIngredient.objects.filter(
+                ingredient_id__in=include
+            ).values('recipe_id').annotate(
+                matched=models.Count('pk')
+            ).filter(matched=len(include)).values('recipe_id'))
+        if exclude:
+            queryset = queryset.exclude(models.Exists(
+                RecipeIngredient.objects.filter(
+                    recipe=models.OuterRef('pk'), ingredient_id__in=exclude)))
+        return queryset
+
+    def facets(self, tags, buckets):
+        """Число рецептов по тегам и интервалам cooking_time одним запросом.
+
+        buckets - возрастающие границы интервалов в минутах.
+        """
+        aliases, aggregates = {}, {}
+        for tag in tags:
+            aliases[f'tag_{tag.pk}_match'] = models.F(
+                'tag_mask').bitand(tag.mask)
+            aggregates[f'tag_{tag.pk}'] = models.Count('pk', filter=models.Q(
+                **{f'tag_{tag.pk}_match__gt': 0}))
+        ranges = list(zip([None, *buckets], [*buckets, None]))
+        for index, (low, high) in enumerate(ranges):
+            condition = models.Q()
+            if low is not None:
+                condition &= models.Q(cooking_time__gte=low)
+            if high is not None:
+                condition &= models.Q(cooking_time__lt=high)
+            aggregates[f'cooking_time_{index}'] = models.Count(
+                'pk', filter=condition)
+        counts = Recipe.objects.filter(
+            pk__in=self.order_by().values('pk')
+        ).alias(**aliases).aggregate(**aggregates)
+        return {
+            'tags': [
+                {'id': tag.pk, 'slug': tag.slug,
+                 'count': counts[f'tag_{tag.pk}']}
+                for tag in tags
+            ],
+            'cooking_time': [
+                {'min': low, 'max': high,
+                 'count': counts[f'cooking_time_{index}']}
+                for index, (low, high) in enumerate(ranges)
+            ],
+        }
+
+    def filter_user_flags(self, user, **flags):
+        """Фильтр по is_favorited / is_in_shopping_cart через EXISTS в WHERE.
+
+        Флаги не аннотируются, поэтому не попадают в COUNT пагинатора.
+        """
+        queryset = self
+        for name, value in flags.items():
+            if not user.is_authenticated:
+                if value:
+                    return queryset.none()
+                continue
+            condition = models.Exists(USER_FLAG_MODELS[name].objects.filter(
+                user=user, recipe=models.OuterRef('pk')))
+            queryset = queryset.filter(condition if value else ~condition)
+        return queryset
+
+
+def set_user_flags(recipes, user):
+    """Проставляет is_favorited и is_in_shopping_cart рецептам страницы.
+
+    Один запрос на флаг по id рецептов страницы.
+    """
+    recipes = list(recipes)
+    recipe_ids = [recipe.pk for recipe in recipes]
+    for name, model in USER_FLAG_MODELS.items():
+        flagged = set()
+        if user.is_authenticated and recipe_ids:
+            flagged = set(model.objects.filter(
+                user=user, recipe_id__in=recipe_ids
+            ).values_list('recipe_id', flat=True))
+        for recipe in recipes:
+            setattr(recipe, name, recipe.pk in flagged)
+    return recipes
+
 
 class Recipe(models.Model):
     """Модель рецептов"""
@@ -88,12 +226,39 @@ class Recipe(models.Model):
         db_index=True,
         editable=False
     )
+    tag_mask = models.BigIntegerField(
+        verbose_name=_('Маска тегов'),
+        default=0,
+        editable=False,
+    )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name=_('В избранном'),
+        default=0,
+        editable=False,
+    )
+    in_carts_count = models.PositiveIntegerField(
+        verbose_name=_('В корзинах'),
+        default=0,
+        editable=False,
+    )
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('Рецепт')
         verbose_name_plural = _('Рецепты')
         ordering = ('-pub_date',)
         default_related_name = 'recipes'
+        indexes = [
+            models.Index(fields=('author', '-pub_date'),
+                         name='recipe_author_pub_date_idx'),
+            models.Index(fields=('-pub_date', '-id'),
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=('-favorites_count', '-pub_date'),
+                         name='recipe_favorites_count_idx'),
+            models.Index(fields=('cooking_time',),
+                         name='recipe_cooking_time_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -155,6 +320,10 @@ class RecipeIngredient(models.Model):
         verbose_name_plural = _('Ингредиенты')
         ordering = ('id',)
         unique_together = ('recipe', 'ingredient')
+        indexes = [
+            models.Index(fields=('ingredient', 'recipe'),
+                         name='recipe_ingredient_lookup_idx'),
+        ]
 
 
 class Favorite(models.Model):
@@ -213,3 +382,409 @@ class ShoppingCart(models.Model):
 
     def __str__(self):
         return f'{self.user} >> {self.recipe}'
+
+
+# Строк в одном INSERT списка покупок (по 3 параметра на строку)
+UPSERT_BATCH_SIZE = 300
+
+USER_FLAG_MODELS = {
+    'is_favorited': Favorite,
+    'is_in_shopping_cart': ShoppingCart,
+}
+
+
+class ShoppingListIngredientManager(models.Manager):
+    """Инкрементальное обновление суммарного списка покупок"""
+
+    def add_recipe(self, user, recipe):
+        self.add_recipes(user, [recipe])
+
+    def remove_recipe(self, user, recipe):
+        self.remove_recipes(user, [recipe])
+
+    def add_recipes(self, user, recipes):
+        self.apply_deltas([user.pk], get_recipes_amounts(recipes))
+
+    def remove_recipes(self, user, recipes):
+        self.apply_deltas([user.pk], {
+            ingredient_id: -amount for ingredient_id, amount
+            in get_recipes_amounts(recipes).items()
+        })
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        """Переносит изменение ингредиентов рецепта в корзины с ним"""
+        deltas = {
+            ingredient_id: (new_amounts.get(ingredient_id, 0)
+                            - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in old_amounts.keys() | new_amounts.keys()
+        }
+        user_ids = ShoppingCart.objects.filter(
+            recipe=recipe).values_list('user_id', flat=True)
+        self.apply_deltas(list(user_ids), deltas)
+
+    def apply_deltas(self, user_ids, deltas):
+        """Прибавляет deltas {ingredient_id: delta} к спискам user_ids.
+
+        Один INSERT ... ON CONFLICT DO UPDATE на пачку строк, поэтому
+        параллельные изменения не падают на IntegrityError. Строки с
+        amount <= 0 затем удаляются.
+        """
+        deltas = {
+            ingredient_id: delta for ingredient_id, delta in deltas.items()
+            if delta
+        }
+        if not user_ids or not deltas:
+            return
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+        user, ingredient, amount = (
+            quote_name(self.model._meta.get_field(name).column)
+            for name in ('user', 'ingredient', 'amount'))
+        rows = [
+            (user_id, ingredient_id, delta)
+            for user_id in user_ids
+            for ingredient_id, delta in deltas.items()
+        ]
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+                batch = rows[start:start + UPSERT_BATCH_SIZE]
+                cursor.execute(
+                    f'INSERT INTO {table} ({user}, {ingredient}, {amount})'
+                    f' VALUES {", ".join(["(%s, %s, %s)"] * len(batch))}'
+                    f' ON CONFLICT ({user}, {ingredient}) DO UPDATE'
+                    f' SET {amount} = {table}.{amount} + EXCLUDED.{amount}',
+                    [param for row in batch for param in row])
+        self.filter(user_id__in=user_ids, ingredient_id__in=deltas,
+                    amount__lte=0).delete()
+
+    def expected_amounts(self, user_ids=None):
+        """Эталонные суммы {(user_id, ingredient_id): amount} по корзинам"""
+        carts = ShoppingCart.objects.all()
+        if user_ids is not None:
+            carts = carts.filter(user_id__in=user_ids)
+        rows = RecipeIngredient.objects.filter(
+            recipe__shopping_cart__in=carts
+        ).values_list(
+            'recipe__shopping_cart__user_id', 'ingredient_id'
+        ).annotate(total=models.Sum('amount')).order_by()
+        return {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in rows
+        }
+
+    def actual_amounts(self, user_ids=None):
+        rows = self.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        return {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount
+            in rows.values_list('user_id', 'ingredient_id', 'amount')
+        }
+
+    def rebuild(self, user_ids=None):
+        rows = self.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        rows.delete()
+        self.bulk_create(
+            self.model(user_id=user_id, ingredient_id=ingredient_id,
+                       amount=amount)
+            for (user_id, ingredient_id), amount
+            in self.expected_amounts(user_ids).items()
+        )
+
+
+def update_tag_masks(recipe_ids):
+    """Пересчитывает Recipe.tag_mask по связям рецептов с тегами"""
+    masks = dict.fromkeys(recipe_ids, 0)
+    if not masks:
+        return
+    for recipe_id, bit in Recipe.tags.through.objects.filter(
+            recipe_id__in=masks, tag__bit__isnull=False
+    ).values_list('recipe_id', 'tag__bit'):
+        masks[recipe_id] |= 1 << bit
+    Recipe.objects.bulk_update(
+        [Recipe(pk=recipe_id, tag_mask=mask)
+         for recipe_id, mask in masks.items()],
+        ['tag_mask'])
+
+
+def get_recipe_amounts(recipe):
+    """Количества ингредиентов рецепта {ingredient_id: amount}"""
+    return dict(RecipeIngredient.objects.filter(
+        recipe=recipe).values_list('ingredient_id', 'amount'))
+
+
+def get_recipes_amounts(recipes):
+    """Суммарные количества ингредиентов рецептов {ingredient_id: amount}"""
+    if not recipes:
+        return {}
+    return dict(RecipeIngredient.objects.filter(
+        recipe__in=recipes
+    ).values_list('ingredient_id').annotate(
+        total=models.Sum('amount')
+    ).order_by())
+
+
+class ShoppingListIngredient(models.Model):
+    """Модель суммарного списка покупок пользователя"""
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name=_('Пользователь'),
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_lists',
+        verbose_name=_('Ингредиент'),
+    )
+    amount = models.IntegerField(
+        verbose_name=_('Количество'),
+        default=0,
+    )
+
+    objects = ShoppingListIngredientManager()
+
+    class Meta:
+        verbose_name = _('Ингредиент списка покупок')
+        verbose_name_plural = _('Списки покупок')
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ingredient'],
+                                    name='unique_shopping_list_ingredient')
+        ]
+
+    def __str__(self):
+        return f'{self.user} >> {self.ingredient_id}: {self.amount}'
+
+
+class ShoppingListExportManager(models.Manager):
+    """Выгрузки списков покупок: поиск готовой и очистка старых"""
+
+    def reusable(self, user, version):
+        """Выгрузка той же версии: готовая или ещё не зависшая.
+
+        Очередь задач живёт в памяти процесса, поэтому выгрузка в статусе
+        pending/running старше SHOPPING_LIST_EXPORT_TIMEOUT считается
+        потерянной при перезапуске.
+        """
+        started_after = timezone.now() - timedelta(
+            seconds=settings.SHOPPING_LIST_EXPORT_TIMEOUT)
+        return self.filter(
+            models.Q(status=self.model.DONE)
+            | models.Q(status__in=(self.model.PENDING, self.model.RUNNING),
+                       created__gte=started_after),
+            user=user, version=version,
+        ).first()
+
+    def expire(self, user=None):
+        """Помечает зависшие выгрузки ошибкой и удаляет выгрузки старше
+        SHOPPING_LIST_EXPORT_TTL вместе с файлами"""
+        exports = self.all()
+        if user is not None:
+            exports = exports.filter(user=user)
+        now = timezone.now()
+        stale = exports.filter(
+            status__in=(self.model.PENDING, self.model.RUNNING),
+            created__lt=now - timedelta(
+                seconds=settings.SHOPPING_LIST_EXPORT_TIMEOUT),
+        ).update(status=self.model.FAILED, error='Выгрузка прервана')
+        # delete() по объектам: файлы удаляет post_delete (см. signals)
+        deleted, _ = exports.filter(created__lt=now - timedelta(
+            seconds=settings.SHOPPING_LIST_EXPORT_TTL)).delete()
+        return stale, deleted
+
+
+class ShoppingListExport(models.Model):
+    """Модель фоновой выгрузки списка покупок в PDF"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    CHOICES_STATUS = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    )
+
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+    )
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_exports',
+        verbose_name=_('Пользователь'),
+    )
+    status = models.CharField(
+        verbose_name=_('Статус'),
+        max_length=16,
+        choices=CHOICES_STATUS,
+        default=PENDING,
+    )
+    version = models.CharField(
+        verbose_name=_('Версия списка покупок'),
+        max_length=40,
+        blank=True,
+    )
+    file = models.FileField(
+        verbose_name=_('Файл'),
+        upload_to='shopping_lists/',
+        blank=True,
+    )
+    error = models.TextField(
+        verbose_name=_('Ошибка'),
+        blank=True,
+    )
+    created = models.DateTimeField(
+        verbose_name=_('Дата создания'),
+        auto_now_add=True,
+    )
+
+    objects = ShoppingListExportManager()
+
+    class Meta:
+        verbose_name = _('Выгрузка списка покупок')
+        verbose_name_plural = _('Выгрузки списков покупок')
+        ordering = ('-created',)
+
+    def __str__(self):
+        return f'{self.user} >> {self.status}'
+
+
+class TimelineEntryManager(models.Manager):
+    """Лента подписок: fan-out при публикации, pull для популярных авторов.
+
+    Рецепты авторов, у которых подписчиков больше TIMELINE_FANOUT_LIMIT,
+    в ленты не раскладываются и дочитываются из Recipe при чтении.
+    """
+
+    def _rows(self, subscriptions):
+        recipes = Recipe.objects.filter(
+            author__followed_by__in=subscriptions,
+            author__followers_count__lte=settings.TIMELINE_FANOUT_LIMIT,
+        ).values_list('author__followed_by__user_id', 'pk', 'author_id',
+                      'pub_date')
+        return (
+            self.model(user_id=user_id, recipe_id=recipe_id,
+                       author_id=author_id, pub_date=pub_date)
+            for user_id, recipe_id, author_id, pub_date in recipes.iterator()
+        )
+
+    def fan_out(self, recipe):
+        """Раскладывает новый рецепт по лентам подписчиков автора"""
+        # Счётчик читается из базы: recipe.author может быть пользователем
+        # запроса из кэша аутентификации с устаревшим followers_count
+        followers_count = CustomUser.objects.filter(
+            pk=recipe.author_id).values_list('followers_count', flat=True)
+        if followers_count.first() > settings.TIMELINE_FANOUT_LIMIT:
+            return
+        follower_ids = Subscription.objects.filter(
+            author_id=recipe.author_id).values_list('user_id', flat=True)
+        self.bulk_create(
+            (self.model(user_id=user_id, recipe=recipe,
+                        author_id=recipe.author_id, pub_date=recipe.pub_date)
+             for user_id in follower_ids.iterator()),
+            batch_size=1000, ignore_conflicts=True,
+        )
+
+    def backfill(self, user, author_ids):
+        """Добавляет в ленту рецепты авторов, на которых подписался user"""
+        self.bulk_create(
+            self._rows(Subscription.objects.filter(
+                user=user, author_id__in=author_ids)),
+            batch_size=1000, ignore_conflicts=True,
+        )
+
+    def prune(self, user, author_ids):
+        """Убирает из ленты рецепты авторов, от которых user отписался"""
+        self.filter(user=user, author_id__in=author_ids).delete()
+
+    def refill(self, author_ids):
+        """Раскладывает рецепты авторов по лентам всех их подписчиков.
+
+        Нужна, когда подписчиков у автора стало не больше
+        TIMELINE_FANOUT_LIMIT: пока их было больше, новые рецепты автора
+        в ленты не попадали, а теперь лента их уже не дочитывает.
+        Пишет подписчики x рецепты строк, поэтому запускается в фоне
+        (api.tasks.submit_timeline_refill).
+        """
+        self.bulk_create(
+            self._rows(Subscription.objects.filter(author_id__in=author_ids)),
+            batch_size=1000, ignore_conflicts=True,
+        )
+
+    def rebuild(self, user_ids=None):
+        rows = self.all()
+        subscriptions = Subscription.objects.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+            subscriptions = subscriptions.filter(user_id__in=user_ids)
+        rows.delete()
+        self.bulk_create(self._rows(subscriptions), batch_size=1000)
+
+    def feed(self, user):
+        """Рецепты ленты user с полем feed_date для сортировки"""
+        pull_author_ids = list(Subscription.objects.filter(
+            user=user,
+            author__followers_count__gt=settings.TIMELINE_FANOUT_LIMIT,
+        ).values_list('author_id', flat=True))
+        if not pull_author_ids:
+            # Диапазонное чтение индекса timeline_user_pub_date_idx
+            return Recipe.objects.filter(
+                timeline_entries__user=user
+            ).annotate(feed_date=models.F('timeline_entries__pub_date'))
+        return Recipe.objects.filter(
+            models.Q(pk__in=self.filter(user=user).values('recipe_id'))
+            | models.Q(author_id__in=pull_author_ids)
+        ).annotate(feed_date=models.F('pub_date'))
+
+
+class TimelineEntry(models.Model):
+    """Модель записи ленты подписок пользователя"""
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name=_('Пользователь'),
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+        verbose_name=_('Рецепт'),
+    )
+    author = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name=_('Автор рецепта'),
+    )
+    pub_date = models.DateTimeField(
+        verbose_name=_('Дата публикации'),
+    )
+
+    objects = TimelineEntryManager()
+
+    class Meta:
+        verbose_name = _('Запись ленты')
+        verbose_name_plural = _('Ленты подписок')
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'],
+                                    name='unique_timeline_entry')
+        ]
+        indexes = [
+            models.Index(fields=('user', '-pub_date', '-recipe'),
+                         name='timeline_user_pub_date_idx'),
+            models.Index(fields=('user', 'author'),
+                         name='timeline_user_author_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} >> {self.recipe_id}'
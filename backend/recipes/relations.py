@@ -0,0 +1,115 @@
+# recipes/relations.py
+"""Идемпотентные переключатели связей (избранное, корзина, подписки).
+
+Добавление - один INSERT ... ON CONFLICT DO NOTHING, удаление - один DELETE,
+в том числе для пакета связей.
+Успех определяется по rowcount, поэтому повторный или параллельный запрос
+не падает на IntegrityError. Сигналы post_save/post_delete здесь не
+отправляются, счётчики из COUNTERS обновляются явно.
+"""
+from django.db import connection
+from django.db.models import F
+from django.db.transaction import atomic
+
+from .counters import COUNTERS, change_counter
+
+
+def _columns(model, values):
+    quote_name = connection.ops.quote_name
+    columns, params = [], []
+    for name, value in values.items():
+        columns.append(quote_name(model._meta.get_field(name).column))
+        params.append(getattr(value, 'pk', value))
+    return columns, params
+
+
+def _update_counters(model, values, delta):
+    for counter_model, field, related_model, foreign_key in COUNTERS:
+        if related_model is not model:
+            continue
+        value = values.get(foreign_key, values.get(f'{foreign_key}_id'))
+        change_counter(counter_model, getattr(value, 'pk', value), field,
+                       delta)
+
+
+def _update_counters_bulk(model, field_name, ids, delta):
+    for counter_model, field, related_model, foreign_key in COUNTERS:
+        if related_model is model and foreign_key == field_name:
+            counter_model.objects.filter(pk__in=ids).update(
+                **{field: F(field) + delta})
+
+
+@atomic
+def add_relation(model, **values):
+    """Добавляет связь; False, если она уже существовала"""
+    columns, params = _columns(model, values)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {connection.ops.quote_name(model._meta.db_table)}'
+            f' ({", ".join(columns)})'
+            f' VALUES ({", ".join(["%s"] * len(params))})'
+            ' ON CONFLICT DO NOTHING',
+            params)
+        added = cursor.rowcount == 1
+    if added:
+        _update_counters(model, values, 1)
+    return added
+
+
+@atomic
+def remove_relation(model, **values):
+    """Удаляет связь; False, если её не было"""
+    columns, params = _columns(model, values)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}'
+            f' WHERE {" AND ".join(f"{column} = %s" for column in columns)}',
+            params)
+        removed = cursor.rowcount == 1
+    if removed:
+        _update_counters(model, values, -1)
+    return removed
+
+
+@atomic
+def add_relations(model, values, field_name, ids):
+    """Добавляет связи values + {field_name: id} для каждого id.
+
+    Возвращает множество id, для которых связь действительно создана.
+    """
+    ids = list(ids)
+    if not ids:
+        return set()
+    columns, params = _columns(model, {**values, field_name: None})
+    params.pop()
+    row = f'({", ".join(["%s"] * len(columns))})'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {connection.ops.quote_name(model._meta.db_table)}'
+            f' ({", ".join(columns)}) VALUES {", ".join([row] * len(ids))}'
+            f' ON CONFLICT DO NOTHING RETURNING {columns[-1]}',
+            [param for pk in ids for param in (*params, pk)])
+        added = {pk for pk, in cursor.fetchall()}
+    _update_counters_bulk(model, field_name, added, 1)
+    return added
+
+
+@atomic
+def remove_relations(model, values, field_name, ids):
+    """Удаляет связи; возвращает множество id действительно удалённых"""
+    ids = list(ids)
+    if not ids:
+        return set()
+    columns, params = _columns(model, {**values, field_name: None})
+    params.pop()
+    conditions = [f'{column} = %s' for column in columns[:-1]]
+    conditions.append(
+        f'{columns[-1]} IN ({", ".join(["%s"] * len(ids))})')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}'
+            f' WHERE {" AND ".join(conditions)} RETURNING {columns[-1]}',
+            [*params, *ids])
+        removed = {pk for pk, in cursor.fetchall()}
+    _update_counters_bulk(model, field_name, removed, -1)
+    return removed
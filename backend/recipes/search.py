@@ -0,0 +1,144 @@
+# recipes/search.py
+"""Полнотекстовый поиск рецептов по названию, описанию и ингредиентам.
+
+PostgreSQL: таблица recipes_recipe_search с колонкой tsvector и GIN-индексом.
+SQLite: виртуальная таблица FTS5 recipes_recipe_search.
+Для прочих СУБД поиск сводится к icontains по названию и описанию.
+"""
+import re
+
+from django.db import connection, models, transaction
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'recipes_recipe_search'
+SEARCH_CONFIG = 'russian'
+
+POSTGRES_CREATE = (
+    f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ('
+    ' recipe_id bigint PRIMARY KEY'
+    ' REFERENCES recipes_recipe (id) ON DELETE CASCADE'
+    ' DEFERRABLE INITIALLY DEFERRED,'
+    ' document tsvector NOT NULL)',
+    f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx'
+    f' ON {SEARCH_TABLE} USING gin (document)',
+)
+POSTGRES_DROP = (f'DROP TABLE IF EXISTS {SEARCH_TABLE}',)
+
+SQLITE_CREATE = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}'
+    ' USING fts5(name, text, ingredients)',
+)
+SQLITE_DROP = (f'DROP TABLE IF EXISTS {SEARCH_TABLE}',)
+
+POSTGRES_UPDATE = f'''
+    INSERT INTO {SEARCH_TABLE} (recipe_id, document)
+    SELECT r.id,
+        setweight(to_tsvector('{SEARCH_CONFIG}', r.name), 'A')
+        || setweight(to_tsvector('{SEARCH_CONFIG}', r.text), 'B')
+        || setweight(to_tsvector('{SEARCH_CONFIG}',
+            coalesce(string_agg(i.name, ' '), '')), 'C')
+    FROM recipes_recipe r
+    LEFT JOIN recipes_recipeingredient ri ON ri.recipe_id = r.id
+    LEFT JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+    WHERE r.id = ANY(%s)
+    GROUP BY r.id
+    ON CONFLICT (recipe_id) DO UPDATE SET document = EXCLUDED.document
+'''
+
+SQLITE_UPDATE = f'''
+    INSERT INTO {SEARCH_TABLE} (rowid, name, text, ingredients)
+    SELECT r.id, r.name, r.text, coalesce(group_concat(i.name, ' '), '')
+    FROM recipes_recipe r
+    LEFT JOIN recipes_recipeingredient ri ON ri.recipe_id = r.id
+    LEFT JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+    WHERE r.id IN ({{placeholders}})
+    GROUP BY r.id
+'''
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def create_search_index(schema_editor):
+    statements = {
+        'postgresql': POSTGRES_CREATE,
+        'sqlite': SQLITE_CREATE,
+    }.get(schema_editor.connection.vendor, ())
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(schema_editor):
+    statements = {
+        'postgresql': POSTGRES_DROP,
+        'sqlite': SQLITE_DROP,
+    }.get(schema_editor.connection.vendor, ())
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def update_recipe_search(recipe_ids, using=connection):
+    """Пересчитывает поисковые документы рецептов"""
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+    with using.cursor() as cursor:
+        if using.vendor == 'postgresql':
+            cursor.execute(POSTGRES_UPDATE, [recipe_ids])
+        elif using.vendor == 'sqlite':
+            placeholders = ', '.join(['%s'] * len(recipe_ids))
+            cursor.execute(
+                f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})',
+                recipe_ids)
+            cursor.execute(
+                SQLITE_UPDATE.format(placeholders=placeholders), recipe_ids)
+
+
+def update_recipe_search_on_commit(recipe_ids):
+    """update_recipe_search после фиксации: ингредиенты рецепта к этому
+    моменту уже сохранены"""
+    recipe_ids = list(recipe_ids)
+    transaction.on_commit(lambda: update_recipe_search(recipe_ids))
+
+
+def delete_recipe_search(recipe_ids, using=connection):
+    recipe_ids = list(recipe_ids)
+    # В PostgreSQL строки удаляются каскадно вместе с рецептом
+    if not recipe_ids or using.vendor != 'sqlite':
+        return
+    placeholders = ', '.join(['%s'] * len(recipe_ids))
+    with using.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})',
+            recipe_ids)
+
+
+def search_recipes(queryset, query):
+    """Фильтрует рецепты по запросу и аннотирует search_rank"""
+    vendor = connection.vendor
+    if vendor == 'postgresql':
+        tsquery = f"plainto_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT recipe_id FROM {SEARCH_TABLE}'
+            f' WHERE document @@ {tsquery}', [query]
+        )).annotate(search_rank=RawSQL(
+            f'SELECT ts_rank(document, {tsquery}) FROM {SEARCH_TABLE}'
+            f' WHERE recipe_id = recipes_recipe.id', [query],
+            output_field=models.FloatField()))
+    if vendor == 'sqlite':
+        tokens = TOKEN_RE.findall(query)
+        if not tokens:
+            return queryset.annotate(search_rank=models.Value(
+                0.0, output_field=models.FloatField())).none()
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        # Таблица FTS присоединяется один раз, bm25 берётся из соединения
+        return queryset.extra(
+            select={'search_rank': f'-bm25({SEARCH_TABLE})'},
+            tables=[SEARCH_TABLE],
+            where=[f'{SEARCH_TABLE} MATCH %s',
+                   f'{SEARCH_TABLE}.rowid = recipes_recipe.id'],
+            params=[match],
+        )
+    return queryset.filter(
+        models.Q(name__icontains=query) | models.Q(text__icontains=query)
+    ).annotate(search_rank=models.Value(
+        0.0, output_field=models.FloatField()))
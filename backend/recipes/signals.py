@@ -0,0 +1,120 @@
+# recipes/signals.py
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save,
+)
+from django.dispatch import receiver
+
+from .counters import COUNTERS, change_counter
+from .models import (
+    Ingredient, Recipe, RecipeIngredient, ShoppingListExport,
+    ShoppingListIngredient, Tag, TimelineEntry, get_recipe_amounts,
+    update_tag_masks,
+)
+from .search import delete_recipe_search, update_recipe_search_on_commit
+from .versions import INGREDIENTS, TAGS, bump_data_version
+
+
+# Версия меняется после фиксации: иначе запрос между bump и COMMIT
+# закэширует старые строки под новой версией
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredient_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_data_version(INGREDIENTS))
+
+
+@receiver(pre_save, sender=Tag)
+def tag_bit_assigned(sender, instance, **kwargs):
+    # pre_save, а не Tag.save(): loaddata сохраняет в обход save()
+    instance._bit_assigned = instance.bit is None
+    if instance._bit_assigned:
+        instance.assign_bit()
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tag_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_data_version(TAGS))
+
+
+@receiver(post_save, sender=Tag)
+def tag_bit_saved(sender, instance, created, raw, **kwargs):
+    # Тег из bulk_create получил бит: маски его рецептов пересчитываются
+    if instance._bit_assigned and not created and not raw:
+        update_tag_masks(list(
+            instance.recipes.values_list('pk', flat=True)))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set,
+                        **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        update_tag_masks([instance.pk])
+    elif action == 'post_clear':
+        # clear() со стороны тега: pk рецептов уже неизвестны
+        Recipe.objects.update(tag_mask=F('tag_mask').bitand(~instance.mask))
+    elif pk_set:
+        update_tag_masks(pk_set)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    # Связи удаляются каскадом без m2m_changed, освобождаем бит вручную
+    Recipe.objects.update(tag_mask=F('tag_mask').bitand(~instance.mask))
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    # До каскадного удаления корзин и ингредиентов рецепта: так список
+    # покупок правится при удалении из админки и вместе с автором
+    ShoppingListIngredient.objects.change_recipe(
+        instance, get_recipe_amounts(instance), {})
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_published(sender, instance, created, **kwargs):
+    if created:
+        TimelineEntry.objects.fan_out(instance)
+
+
+# Поисковый индекс обновляется при любом сохранении (API, админка,
+# loaddata). bulk_create ингредиентов сигналов не шлёт, такие места
+# вызывают update_recipe_search_on_commit сами
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, update_fields, **kwargs):
+    if update_fields is None or {'name', 'text'} & set(update_fields):
+        update_recipe_search_on_commit([instance.pk])
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_removed(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: delete_recipe_search([pk]))
+
+
+@receiver((post_save, post_delete), sender=RecipeIngredient)
+def recipe_ingredient_changed(sender, instance, **kwargs):
+    update_recipe_search_on_commit([instance.recipe_id])
+
+
+@receiver(post_delete, sender=ShoppingListExport)
+def shopping_list_export_deleted(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+def counter_receivers(sender, model, field, foreign_key):
+    """Подключает обновление счётчика к созданию и удалению sender"""
+    @receiver(post_save, sender=sender, weak=False)
+    def created(instance, created, **kwargs):
+        if created:
+            change_counter(model, getattr(instance, foreign_key), field, 1)
+
+    @receiver(post_delete, sender=sender, weak=False)
+    def deleted(instance, **kwargs):
+        change_counter(model, getattr(instance, foreign_key), field, -1)
+
+
+for model, field, related_model, foreign_key in COUNTERS:
+    counter_receivers(related_model, model, field, f'{foreign_key}_id')
@@ -0,0 +1,28 @@
+# recipes/versions.py
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+INGREDIENTS = 'ingredients'
+TAGS = 'tags'
+
+
+def get_data_version(name):
+    """Текущая версия справочных данных, общая для всех процессов.
+
+    Общая только при общем бэкенде кэша; с LocMemCache версия процесса
+    обновляется по истечении DATA_VERSION_TIMEOUT.
+    """
+    key = f'data_version:{name}'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, settings.DATA_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_data_version(name):
+    """Новая версия данных: процессы пересоберут свои локальные копии"""
+    cache.set(f'data_version:{name}', uuid.uuid4().hex,
+              settings.DATA_VERSION_TIMEOUT)
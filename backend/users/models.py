@@ -52,6 +52,16 @@ class CustomUser(AbstractUser):
         default=USER,
         choices=CHOICES_ROLE
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name=_('Количество рецептов'),
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name=_('Количество подписчиков'),
+        default=0,
+        editable=False,
+    )
     following = models.ManyToManyField(
         "self",
         through='Subscription',